@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for the evcape matching engine.
+
+This feeds a synthetic stream of key events through the matcher, without
+using any input devices, and reports throughput and per-event latency
+percentiles for various numbers of rules and pattern lengths::
+
+  ./benchmark.py
+  ./benchmark.py --rules 1,100 --lengths 2,8 --events 50000 --grab
+
+Instead of synthetic typing, a trace made with ``evcape record`` can be
+used as the event stream::
+
+  ./benchmark.py --trace typing.trace
+
+With ``--monitor``, this instead compares the per-event overhead of the
+selector based KeyboardMonitor with the asyncio based AsyncKeyboardMonitor,
+by writing raw input events into a pipe that is monitored like a keyboard::
+
+  ./benchmark.py --monitor --events 50000
+
+With ``--startup``, this instead checks that importing evcape and running
+``evcape check`` stay within a time budget without loading evdev or pyudev,
+and exits with an error otherwise::
+
+  ./benchmark.py --startup
+"""
+
+import argparse
+import array
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import time
+
+import evcape
+
+# letters, digits and the like; rules and typing use these keys
+KEYS = list(range(2, 54))
+EVENT_INTERVAL = 30_000_000  # 30ms in nanoseconds
+TIMEOUT = 1_000_000_000
+
+# startup budgets in milliseconds, including interpreter startup
+IMPORT_BUDGET = 150
+CHECK_BUDGET = 250
+STARTUP_RUNS = 5
+
+
+class NullWriter:
+    """
+    Writer that discards everything, to measure the matcher in isolation.
+    """
+
+    def add(self, code, value, timestamp=0):
+        pass
+
+    def flush(self):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rules", default="1,10,1000,10000")
+    parser.add_argument("--lengths", default="2,4,8")
+    parser.add_argument("--events", type=int, default=200_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace", help="use events from a recorded trace")
+    parser.add_argument(
+        "--grab",
+        action="store_true",
+        help="forward all events, like evcape --grab",
+    )
+    parser.add_argument(
+        "--devnull",
+        action="store_true",
+        help="write output to /dev/null instead of discarding it",
+    )
+    parser.add_argument(
+        "--monitor",
+        action="store_true",
+        help="compare the keyboard monitors instead",
+    )
+    parser.add_argument(
+        "--startup",
+        action="store_true",
+        help="check startup time and lazy imports instead",
+    )
+    args = parser.parse_args()
+
+    if args.startup:
+        raise SystemExit(startup())
+    if args.monitor:
+        monitor_benchmarks(args.events)
+        return
+
+    trace_events = None
+    if args.trace:
+        with open(args.trace, "rb") as fp:
+            trace_events = list(evcape.read_trace(fp))
+
+    print(
+        f"{'rules':>6} {'length':>6} {'states':>8} {'compile':>9} "
+        f"{'events/s':>10} {'p50':>7} {'p90':>7} {'p99':>7} {'max':>9}"
+    )
+    for rule_count in map(int, args.rules.split(",")):
+        for length in map(int, args.lengths.split(",")):
+            rng = random.Random(args.seed)
+            rules = make_rules(rule_count, length, rng)
+            events = trace_events or make_events(rules, args.events, rng)
+            result = benchmark(rules, events, grab=args.grab, devnull=args.devnull)
+            print(
+                f"{rule_count:>6} {length:>6} {result['states']:>8} "
+                f"{result['compile'] / 1e6:>7.1f}ms {result['rate']:>10.0f} "
+                f"{result['p50']:>5}ns {result['p90']:>5}ns {result['p99']:>5}ns "
+                f"{result['max']:>7}ns"
+            )
+
+
+def make_rules(count, length, rng):
+    """
+    Make rules with distinct patterns of the given number of events.
+
+    Patterns consist of random key presses and releases.
+    """
+    actions = [
+        evcape.encode_key_event(evcape.KEY_CODES["esc"], 1),
+        evcape.encode_key_event(evcape.KEY_CODES["esc"], 0),
+    ]
+    key_events = [
+        evcape.encode_key_event(code, value) for code in KEYS for value in (0, 1)
+    ]
+    count = min(count, len(key_events) ** length)
+    patterns = set()
+    while len(patterns) < count:
+        patterns.add(tuple(rng.choice(key_events) for _ in range(length)))
+    return [
+        evcape.Rule(patterns=list(pattern), actions=actions)
+        for pattern in sorted(patterns)
+    ]
+
+
+def make_events(rules, count, rng):
+    """
+    Make a stream of (device_name, timestamp, code, value) events.
+
+    This is random typing on a single keyboard, with the patterns of random
+    rules mixed in.
+    """
+    events = []
+    timestamp = 0
+    while len(events) < count:
+        if rng.random() < 0.1:
+            key_events = rng.choice(rules).patterns
+        else:
+            code = rng.choice(KEYS)
+            key_events = [
+                evcape.encode_key_event(code, 1),
+                evcape.encode_key_event(code, 0),
+            ]
+        for key_event in key_events:
+            timestamp += EVENT_INTERVAL
+            code, value = evcape.decode_key_event(key_event)
+            events.append(("synthetic", timestamp, code, value))
+    return events[:count]
+
+
+def benchmark(rules, events, grab=False, devnull=False):
+    clock = time.perf_counter_ns
+
+    start = clock()
+    automaton = evcape.RuleAutomaton(rules)
+    compile_time = clock() - start
+    matcher = evcape.Matcher(automaton, timeout=TIMEOUT, grab=grab)
+
+    if devnull:
+        fd = os.open(os.devnull, os.O_WRONLY)
+        matcher.writer = evcape.FrameWriter(fd)
+    else:
+        fd = None
+        matcher.writer = NullWriter()
+    flush = matcher.writer.flush
+    feed = matcher.feed
+
+    # throughput, without timing individual events
+    events_with_state = with_device_states(matcher, events)
+    start = clock()
+    for state, timestamp, code, value in events_with_state:
+        feed(state, timestamp, code, value)
+        flush()
+    rate = len(events) / ((clock() - start) / 1e9)
+
+    # latency per event, which includes the overhead of the clock calls
+    events_with_state = with_device_states(matcher, events)
+    latencies = array.array("q", bytes(8 * len(events)))
+    for i, (state, timestamp, code, value) in enumerate(events_with_state):
+        start = clock()
+        feed(state, timestamp, code, value)
+        flush()
+        latencies[i] = clock() - start
+    latencies = sorted(latencies)
+
+    if fd is not None:
+        os.close(fd)
+
+    return {
+        "states": len(matcher.automaton.accepts),
+        "compile": compile_time,
+        "rate": rate,
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "max": latencies[-1],
+    }
+
+
+class PipeKeyboard:
+    """
+    Pipe that is monitored like a keyboard, using raw input events.
+    """
+
+    name = "pipe"
+
+    def __init__(self):
+        self.fd, self.write_fd = os.pipe()
+        os.set_blocking(self.fd, False)
+        self.path = f"/proc/self/fd/{self.fd}"
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+        os.close(self.write_fd)
+
+
+def monitor_benchmarks(count):
+    print(f"{'monitor':>8} {'events/s':>10} {'p50':>7} {'p90':>7} {'p99':>7}")
+    for name, function in [
+        ("none", benchmark_pipe),
+        ("selector", benchmark_monitor),
+        ("asyncio", lambda *args: asyncio.run(benchmark_async_monitor(*args))),
+    ]:
+        keyboard = PipeKeyboard()
+        events = make_raw_events(count)
+        try:
+            latencies = function(keyboard, events)
+        finally:
+            keyboard.close()
+        rate = len(latencies) / (sum(latencies) / 1e9)
+        latencies = sorted(latencies)
+        print(
+            f"{name:>8} {rate:>10.0f} {percentile(latencies, 50):>5}ns "
+            f"{percentile(latencies, 90):>5}ns {percentile(latencies, 99):>5}ns"
+        )
+
+
+def make_raw_events(count):
+    """
+    Make packed input_event structs for alternating presses and releases.
+    """
+    return [
+        evcape.INPUT_EVENT.pack(0, i, evcape.EV_KEY, KEYS[0], (i + 1) % 2)
+        for i in range(count)
+    ]
+
+
+def benchmark_pipe(keyboard, events):
+    """
+    Write and read each event without any monitor, as a baseline.
+    """
+    clock = time.perf_counter_ns
+    buffer = bytearray(evcape.RAW_READ_SIZE)
+    latencies = array.array("q", bytes(8 * len(events)))
+    for i, event in enumerate(events):
+        start = clock()
+        os.write(keyboard.write_fd, event)
+        list(evcape.read_raw_input_device_events(keyboard, buffer))
+        latencies[i] = clock() - start
+    return latencies
+
+
+def new_monitor(monitor_class, keyboard):
+    # no keys, so that real keyboards are not monitored
+    monitor = monitor_class(ignored_devices=[], keys=set(), raw=True)
+    monitor.register(keyboard, "keyboard")
+    return monitor
+
+
+def benchmark_monitor(keyboard, events):
+    clock = time.perf_counter_ns
+    latencies = array.array("q", bytes(8 * len(events)))
+    with new_monitor(evcape.KeyboardMonitor, keyboard) as monitor:
+        monitor_events = iter(monitor)
+        for i, event in enumerate(events):
+            start = clock()
+            os.write(keyboard.write_fd, event)
+            next(monitor_events)
+            latencies[i] = clock() - start
+    return latencies
+
+
+async def benchmark_async_monitor(keyboard, events):
+    clock = time.perf_counter_ns
+    latencies = array.array("q", bytes(8 * len(events)))
+    with new_monitor(evcape.AsyncKeyboardMonitor, keyboard) as monitor:
+        monitor_events = aiter(monitor)
+        for i, event in enumerate(events):
+            start = clock()
+            os.write(keyboard.write_fd, event)
+            await anext(monitor_events)
+            latencies[i] = clock() - start
+        await monitor_events.aclose()
+    return latencies
+
+
+def startup():
+    """
+    Check startup time against the budgets; return an error message, if any.
+
+    Each command runs in a fresh interpreter, and the fastest of several
+    runs counts, to reduce noise from the rest of the system.
+    """
+    evcape_dir = os.path.dirname(os.path.abspath(evcape.__file__))
+    lazy_modules = ["evdev", "pyudev"]
+    import_code = (
+        "import sys, evcape; "
+        f"loaded = [m for m in {lazy_modules!r} if m in sys.modules]; "
+        "sys.exit(f'imported eagerly: {loaded}' if loaded else 0)"
+    )
+    commands = [
+        ("import", [sys.executable, "-c", import_code], IMPORT_BUDGET),
+        ("check", [sys.executable, "evcape.py", "check"], CHECK_BUDGET),
+    ]
+    errors = []
+    for name, command, budget in commands:
+        durations = []
+        for _ in range(STARTUP_RUNS):
+            start = time.perf_counter_ns()
+            result = subprocess.run(
+                command, cwd=evcape_dir, capture_output=True, text=True
+            )
+            durations.append((time.perf_counter_ns() - start) / 1e6)
+            if result.returncode != 0:
+                errors.append(f"{name}: {result.stderr.strip()}")
+                break
+        duration = min(durations)
+        print(f"{name:>6} {duration:>7.1f}ms (budget {budget}ms)")
+        if duration > budget:
+            errors.append(f"{name}: {duration:.1f}ms exceeds budget of {budget}ms")
+    return "\n".join(errors) or None
+
+
+def with_device_states(matcher, events):
+    """
+    Replace device names with fresh matcher states, outside the timed loops.
+    """
+    device_states = {}
+    return [
+        (device_states.setdefault(device_name, matcher.new_state()), *event)
+        for device_name, *event in events
+    ]
+
+
+def percentile(sorted_values, p):
+    index = min(len(sorted_values) - 1, len(sorted_values) * p // 100)
+    return sorted_values[index]
+
+
+if __name__ == "__main__":
+    main()
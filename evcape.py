@@ -1,14 +1,25 @@
 #!/usr/bin/env python3
 
 import argparse
+import array
 import collections
+import contextlib
 import errno
+import fcntl
 import functools
+import hashlib
+import heapq
+import json
 import logging
+import marshal
+import os
 import selectors
-
-import evdev
-import pyudev
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
 
 logger = logging.getLogger("evcape")
 
@@ -17,6 +28,20 @@ DEFAULT_RULES = [
     "press:capslock,release:capslock=press:esc,release:esc",
 ]
 DEFAULT_TIMEOUT = 1000
+DEFAULT_CHORD_TIMEOUT = 50
+DEFAULT_TAP_TIMEOUT = 250
+
+# pressed keys are kept as bitsets, with bit n set if key code n is pressed.
+# leftctrl, leftshift, rightshift, leftalt, rightctrl, rightalt, leftmeta and
+# rightmeta are modifiers.
+MODIFIER_KEYS = sum(1 << code for code in [29, 42, 54, 56, 97, 100, 125, 126])
+
+# rule conditions, and the keys that may be pressed besides the key of the
+# event completing the pattern
+RULE_CONDITIONS = {
+    "alone": 0,
+    "mods-only": MODIFIER_KEYS,
+}
 
 KEY_EVENT_VALUE_TO_ACTION = {
     0: "release",
@@ -26,33 +51,656 @@ ACTION_TO_KEY_EVENT_VALUE = {
     value: key for key, value in KEY_EVENT_VALUE_TO_ACTION.items()
 }
 
+# event types and codes from linux/input-event-codes.h
+EV_SYN = 0x00
+EV_KEY = 0x01
+EV_MSC = 0x04
+EV_LED = 0x11
+EV_REP = 0x14
+SYN_REPORT = 0
+SYN_DROPPED = 3
+
+# key events (press or release of a key code) are represented as a single
+# integer, code * 2 + value, which can directly index into dense tables
+KEY_CNT = 0x300
+KEY_EVENT_CNT = KEY_CNT * 2
+
+# struct input_event from linux/input.h
+INPUT_EVENT = struct.Struct("llHHi")
+RAW_READ_SIZE = 64 * INPUT_EVENT.size
+
+# struct input_mask and the EVIOCSMASK ioctl from linux/input.h
+INPUT_MASK = struct.Struct("IIQ")
+EVIOCSMASK = 1 << 30 | INPUT_MASK.size << 16 | ord("E") << 8 | 0x93
+EV_CNT = 0x20
+
+# the EVIOCSCLOCKID ioctl from linux/input.h
+EVIOCSCLOCKID = 1 << 30 | 4 << 16 | ord("E") << 8 | 0xA0
+
+# event types of devices that can be grabbed. only key events are forwarded,
+# and the others are not needed by the session, unlike e.g. pointer events.
+GRABBABLE_EVENT_TYPES = {EV_SYN, EV_KEY, EV_MSC, EV_LED, EV_REP}
+
+# the EVIOCGKEY ioctl from linux/input.h, for a bitmask of all key codes
+EVIOCGKEY = 2 << 30 | KEY_CNT // 8 << 16 | ord("E") << 8 | 0x18
+
+TRACE_MAGIC = b"EVCT\x01"
+
+CONFIG_CHECK_INTERVAL = 1_000_000_000  # 1s in nanoseconds
+GRAB_RETRY_INTERVAL = 50_000_000  # 50ms in nanoseconds
+
+# bump when the format of compiled rules changes
+CACHE_VERSION = 6
+
 
 def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("rules", nargs="*", metavar="rule", default=DEFAULT_RULES)
-    parser.add_argument("--timeout", type=int, default=DEFAULT_TIMEOUT)
-    args = parser.parse_args()
+    commands = {
+        "check": check,
+        "control": control,
+        "record": record,
+        "replay": replay,
+    }
+    argv = sys.argv[1:]
+    if argv and argv[0] in commands:
+        commands[argv[0]](argv[1:])
+    else:
+        run(argv)
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(
+        prog="evcape",
+        epilog=(
+            "other commands: check, control, record, replay "
+            "(use --help after a command)"
+        ),
+    )
+    add_rule_arguments(parser)
+    parser.add_argument(
+        "--raw",
+        action="store_true",
+        help="decode input events directly instead of using python-evdev",
+    )
+    parser.add_argument(
+        "--shared-state",
+        action="store_true",
+        help="match sequences across keyboards instead of per keyboard",
+    )
+    parser.add_argument(
+        "--grab",
+        action="store_true",
+        help="grab keyboards and forward their events, so rules can consume them",
+    )
+    parser.add_argument(
+        "--control-socket",
+        metavar="path",
+        help="serve stats, state and reload commands on this unix socket",
+    )
+    args = parser.parse_args(argv)
 
     logging.basicConfig(level=logging.INFO)
 
-    timeout = args.timeout / 1000
-    logger.info(f"using timeout {args.timeout}ms")
+    try:
+        automaton = compile_rules(args)
+    except (OSError, ValueError) as exc:
+        raise SystemExit(f"error: {exc}")
+    rules = automaton.rules
+    matcher = Matcher(
+        automaton,
+        timeout=args.timeout * 1_000_000,
+        grab=args.grab,
+        shared_state=args.shared_state,
+    )
+
+    keyboard_monitor = KeyboardMonitor(
+        ignored_devices=[],
+        keys=rule_keys(rules, "patterns"),
+        raw=args.raw,
+        grab=args.grab,
+        new_device_state=matcher.new_state,
+        drop_device_state=matcher.drop_state,
+    )
+    matcher.call_at = keyboard_monitor.call_at
+
+    # when grabbing, the uinput device also mirrors all keys of the grabbed
+    # keyboards, so that their events can be forwarded.
+    uinput_keys = rule_keys(rules, "actions") | keyboard_monitor.grabbed_keys
+    uinput = create_uinput(uinput_keys)
+    matcher.writer = FrameWriter(uinput.fd)
+    keyboard_monitor.ignored_devices.append(uinput.device.path)
+    keyboard_monitor.forwardable_keys = uinput_keys
+    keyboard_monitor.on_idle = matcher.writer.flush
+
+    # measure the delay between the kernel timestamp of an event and the
+    # moment processing starts, and the moment the resulting frame is written
+    matcher.queue_latency = LatencyHistogram()
+    matcher.writer.latency = LatencyHistogram()
+
+    def log_latency(signum, frame):
+        logger.info(f"queue latency: {matcher.queue_latency.summary()}")
+        logger.info(f"output latency: {matcher.writer.latency.summary()}")
+
+    signal.signal(signal.SIGUSR1, log_latency)
+
+    def resync(input_device):
+        # keyboards get a fresh state after dropping events, but the shared
+        # state is used by all of them. the pressed keys are obtained from
+        # the kernel.
+        device_state = keyboard_monitor.device_states[input_device.path]
+        if matcher.shared_state is not None:
+            device_state.reset(matcher.automaton)
+        try:
+            pressed_keys = 0
+            for other_input_device in keyboard_monitor.input_devices():
+                pressed_keys |= read_pressed_keys(other_input_device)
+            if matcher.shared_state is not None:
+                matcher.set_pressed(device_state, pressed_keys)
+            else:
+                matcher.set_pressed(device_state, read_pressed_keys(input_device))
+            if not args.grab:
+                return
+            # a dropped release was never forwarded, so release keys that are
+            # pressed on the uinput device but not on any keyboard.
+            stuck_keys = read_pressed_keys(uinput.device) & ~pressed_keys
+        except OSError as exc:
+            logger.warning(f"could not resync pressed keys: {exc}")
+            return
+        for code in iter_bits(stuck_keys):
+            matcher.writer.add(code, 0)
+        matcher.writer.flush()
+
+    keyboard_monitor.on_resync = resync
+
+    # rules are compiled by a worker thread, so that key events are processed
+    # in the meantime. the monitor loop swaps in the result once the worker
+    # signals that it is done. a reload requested while another one runs is
+    # started afterwards, so that it sees the latest config file.
+    reload_socket, reload_wakeup_socket = socket.socketpair()
+    reload_thread = None
+    reload_again = False
+    reload_result = None
+
+    def reload():
+        nonlocal reload_thread, reload_again
+        if reload_thread is not None:
+            reload_again = True
+        else:
+            reload_thread = threading.Thread(
+                target=compile_in_background, name="evcape-reload", daemon=True
+            )
+            reload_thread.start()
+        return {"reloading": True}
+
+    def compile_in_background():
+        nonlocal reload_result
+        try:
+            reload_result = compile_rules(args)
+        except Exception as exc:
+            reload_result = exc
+        reload_wakeup_socket.send(b"\0")
+
+    def finish_reload(sock):
+        nonlocal reload_thread, reload_again
+        sock.recv(64)
+        reload_thread.join()
+        reload_thread = None
+        if isinstance(reload_result, Exception):
+            logger.error(f"could not reload rules: {reload_result}")
+        else:
+            try:
+                use_automaton(reload_result)
+            except (OSError, RuntimeError) as exc:
+                logger.error(f"could not reload rules: {exc}")
+        if reload_again:
+            reload_again = False
+            reload()
+
+    def use_automaton(automaton):
+        # the uinput device is only recreated when the new actions use keys it
+        # does not have, since that makes it disappear and reappear for the
+        # session.
+        nonlocal uinput
+        rules = automaton.rules
+        missing_keys = rule_keys(rules, "actions") - uinput_keys
+        if missing_keys:
+            uinput_keys.update(missing_keys)
+            matcher.writer.flush()
+            previous_uinput = uinput
+            uinput = create_uinput(uinput_keys)
+            matcher.writer.fd = uinput.fd
+            keyboard_monitor.ignored_devices.append(uinput.device.path)
+            # the kernel reuses device nodes, so a keyboard may get this one
+            keyboard_monitor.ignored_devices.remove(previous_uinput.device.path)
+            previous_uinput.close()
+        keys = rule_keys(rules, "patterns")
+        new_keys = keys - keyboard_monitor.keys
+        keyboard_monitor.keys = keys
+        matcher.set_automaton(automaton)
+        logger.info(f"reloaded {len(rules)} rules")
+        if new_keys:
+            # keyboards skipped before may have keys used by the new rules.
+            # adding keyboards is idempotent, so add all of them again.
+            keyboard_monitor.add_existing_keyboards()
+
+    keyboard_monitor.add_reader(reload_socket, finish_reload)
+
+    # reload on SIGHUP. the signal handler itself does nothing, but the
+    # wakeup fd makes the selector return, so the reload happens right away.
+    signal_socket, signal_wakeup_socket = socket.socketpair()
+    signal_wakeup_socket.setblocking(False)
+    signal.set_wakeup_fd(signal_wakeup_socket.fileno())
+    signal.signal(signal.SIGHUP, lambda signum, frame: None)
+
+    def handle_signals(sock):
+        if signal.SIGHUP in sock.recv(64):
+            logger.info("received SIGHUP")
+            reload()
+
+    keyboard_monitor.add_reader(signal_socket, handle_signals)
+
+    # reload when the config file changes
+    if args.config:
+        config_version = file_version(args.config)
+
+        def check_config():
+            nonlocal config_version
+            version = file_version(args.config)
+            if version != config_version:
+                config_version = version
+                logger.info(f"{args.config} changed")
+                reload()
+            keyboard_monitor.call_at(
+                time.monotonic_ns() + CONFIG_CHECK_INTERVAL, check_config
+            )
+
+        check_config()
+
+    control_server = contextlib.nullcontext()
+    if args.control_socket:
+        control_server = ControlServer(
+            args.control_socket,
+            keyboard_monitor,
+            commands={
+                "stats": lambda: {
+                    "events_read": keyboard_monitor.events_read,
+                    "repeats_dropped": keyboard_monitor.repeats_dropped,
+                    "overflows": keyboard_monitor.overflows,
+                    "frames_written": matcher.writer.frames_written,
+                    "rule_hits": [
+                        {"rule": rule.to_string(), "hits": hits}
+                        for rule, hits in zip(
+                            matcher.automaton.rules, matcher.rule_hits
+                        )
+                    ],
+                    "queue_latency": matcher.queue_latency.as_dict(),
+                    "output_latency": matcher.writer.latency.as_dict(),
+                },
+                "devices": lambda: [
+                    {"path": input_device.path, "name": input_device.name}
+                    for input_device in keyboard_monitor.input_devices()
+                ],
+                "state": lambda: {
+                    device_name: {
+                        "state": device_state.state,
+                        "previous_timestamp": device_state.previous_timestamp,
+                        "pressed": format_keys(device_state.pressed),
+                    }
+                    for device_name, device_state in (
+                        keyboard_monitor.device_states.items()
+                    )
+                },
+                "reload": reload,
+            },
+        )
+        logger.info(f"serving control socket on {args.control_socket}")
+
+    try:
+        with keyboard_monitor, control_server:
+            feed = matcher.feed
+            for device_state, timestamp, code, value in keyboard_monitor:
+                feed(device_state, timestamp, code, value)
+    finally:
+        uinput.close()
+
+
+def record(argv):
+    parser = argparse.ArgumentParser(
+        prog="evcape record",
+        description="record key events from all keyboards into a trace file",
+    )
+    parser.add_argument("trace")
+    parser.add_argument(
+        "--raw",
+        action="store_true",
+        help="decode input events directly instead of using python-evdev",
+    )
+    args = parser.parse_args(argv)
 
-    for s in args.rules:
+    logging.basicConfig(level=logging.INFO)
+
+    keyboard_monitor = KeyboardMonitor(
+        ignored_devices=[],
+        raw=args.raw,
+        new_device_state=lambda device_name, grab=False: device_name,
+    )
+    with keyboard_monitor, open(args.trace, "wb") as fp:
+        trace_writer = TraceWriter(fp)
+        logger.info(f"recording to {args.trace}; press ctrl-c to stop")
+        try:
+            for device_name, timestamp, code, value in keyboard_monitor:
+                trace_writer.write(device_name, timestamp, code, value)
+        except KeyboardInterrupt:
+            pass
+    logger.info(f"recorded {trace_writer.count} events")
+
+
+def replay(argv):
+    parser = argparse.ArgumentParser(
+        prog="evcape replay",
+        description=(
+            "feed a recorded trace through the rules and print the resulting actions"
+        ),
+    )
+    parser.add_argument("trace")
+    add_rule_arguments(parser)
+    parser.add_argument(
+        "--shared-state",
+        action="store_true",
+        help="match sequences across keyboards instead of per keyboard",
+    )
+    parser.add_argument(
+        "--realtime",
+        action="store_true",
+        help="replay at the original timing instead of at maximum speed",
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        automaton = compile_rules(args)
+    except (OSError, ValueError) as exc:
+        raise SystemExit(f"error: {exc}")
+    writer = PrintWriter()
+    matcher = Matcher(
+        automaton,
+        timeout=args.timeout * 1_000_000,
+        writer=writer,
+        shared_state=args.shared_state,
+    )
+
+    # deadlines are resolved in trace time, like the daemon does in real time
+    timers = []
+    now = 0
+
+    def call_at(deadline, callback, *args):
+        timer = Timer(deadline, callback, args)
+        heapq.heappush(timers, timer)
+        return timer
+
+    def advance(timestamp):
+        nonlocal now
+        if args.realtime:
+            delay = start + timestamp - writer.start_timestamp - time.monotonic_ns()
+            if delay > 0:
+                time.sleep(delay / 1_000_000_000)
+        now = writer.timestamp = timestamp
+
+    def run_timers(until):
+        while timers and timers[0].deadline <= until:
+            timer = heapq.heappop(timers)
+            if not timer.cancelled:
+                advance(timer.deadline)
+                timer.callback(*timer.args)
+
+    matcher.call_at = call_at
+    matcher.clock = lambda: now
+    device_states = {}
+    count = 0
+    start = time.monotonic_ns()
+    with open(args.trace, "rb") as fp:
+        for device_name, timestamp, code, value in read_trace(fp):
+            if count == 0:
+                writer.start_timestamp = timestamp
+            run_timers(timestamp)
+            advance(timestamp)
+            device_state = device_states.get(device_name)
+            if device_state is None:
+                device_state = device_states[device_name] = matcher.new_state(
+                    device_name
+                )
+            matcher.feed(device_state, timestamp, code, value)
+            count += 1
+    run_timers(float("inf"))
+    duration = (time.monotonic_ns() - start) / 1_000_000_000
+    logger.info(
+        f"replayed {count} events from {len(device_states)} devices "
+        f"in {duration:.3f}s ({writer.count} frames written)"
+    )
+
+
+def check(argv):
+    parser = argparse.ArgumentParser(
+        prog="evcape check",
+        description="check the rules from the command line and config file",
+    )
+    add_rule_arguments(parser)
+    args = parser.parse_args(argv)
+
+    try:
+        automaton = RuleAutomaton(parse_rules(args))
+    except (OSError, ValueError) as exc:
+        raise SystemExit(f"error: {exc}")
+    print(f"ok: {len(automaton.rules)} rules, {len(automaton.accepts)} states")
+
+
+def control(argv):
+    parser = argparse.ArgumentParser(
+        prog="evcape control",
+        description="send a command to a running evcape and print the response",
+    )
+    parser.add_argument("socket")
+    parser.add_argument("command", choices=["stats", "devices", "state", "reload"])
+    args = parser.parse_args(argv)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(args.socket)
+        sock.sendall(f"{args.command}\n".encode())
+        response = b""
+        while chunk := sock.recv(65536):
+            response += chunk
+    response = json.loads(response)
+    print(json.dumps(response, indent=2))
+    if "error" in response:
+        raise SystemExit(1)
+
+
+def add_rule_arguments(parser):
+    parser.add_argument("rules", nargs="*", metavar="rule")
+    parser.add_argument(
+        "--config",
+        metavar="path",
+        help="read rules from this file, one per line, and reload it on changes",
+    )
+    parser.add_argument("--timeout", type=int, default=DEFAULT_TIMEOUT)
+
+
+def parse_rules(args):
+    """
+    Parse the rules from the command line and the config file.
+
+    Without any rules, the default rules are used.
+    """
+    logger.info(f"using timeout {args.timeout}ms")
+    rule_strings = list(args.rules)
+    if args.config:
+        rule_strings.extend(read_config(args.config))
+    if not rule_strings:
+        rule_strings = DEFAULT_RULES
+    for s in rule_strings:
         logger.info(f"adding rule {s!r}")
-    rules = [Rule.from_string(s) for s in args.rules]
-    assert len(rules) > 0
-    rules_by_last_event = {}
-    for rule in rules:
-        key = rule.patterns[-1]
-        rules_by_last_event.setdefault(key, []).append(rule)
-
-    # tell the uinput device about the exact keys used in rule actions since
-    # the default value causes events not to propagate to the session somehow;
-    # see also https://gitlab.gnome.org/GNOME/mutter/-/issues/1869
-    keys = sorted({code for rule in rules for _, code in rule.actions})
+    return [Rule.from_string(s) for s in rule_strings]
+
+
+def compile_rules(args):
+    """
+    Parse and compile the rules from the command line and the config file.
+
+    When a config file is used, the compiled automaton is cached, so that
+    startup does not have to parse the rules and resolve key names. The cache
+    is valid as long as the config file has the same modification time and
+    size, or else the same contents, and the command line has the same rules.
+    """
+    if not args.config:
+        return RuleAutomaton(parse_rules(args))
+
+    cache_path = os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "evcape",
+        hashlib.sha256(os.path.abspath(args.config).encode()).hexdigest(),
+    )
+    version = file_version(args.config)
+    try:
+        cache = read_cache(cache_path)
+    except Exception:
+        cache = {}
+    if cache.get("cache_version") != CACHE_VERSION or cache.get("rules") != args.rules:
+        cache = {}
+    if version is not None and cache.get("version") == version:
+        logger.info(f"using cached rules for {args.config}")
+        return automaton_from_cache(cache["automaton"])
+
+    with open(args.config, "rb") as fp:
+        digest = hashlib.sha256(fp.read()).hexdigest()
+    if cache.get("digest") == digest:
+        logger.info(f"using cached rules for {args.config}")
+        automaton = automaton_from_cache(cache["automaton"])
+    else:
+        automaton = RuleAutomaton(parse_rules(args))
+
+    cache = {
+        "cache_version": CACHE_VERSION,
+        "rules": args.rules,
+        "version": version,
+        "digest": digest,
+        "automaton": automaton_to_cache(automaton),
+    }
+    try:
+        write_cache(cache_path, cache)
+    except OSError as exc:
+        logger.warning(f"could not write rule cache {cache_path}: {exc}")
+    return automaton
+
+
+def read_cache(path):
+    """
+    Read a rule cache, if it is owned by the current user.
+
+    The cache uses marshal, which (unlike pickle) cannot run code when
+    loading, since evcape often runs as root, while the cache directory may
+    be writable by another user.
+    """
+    with open(path, "rb") as fp:
+        if os.fstat(fp.fileno()).st_uid != os.getuid():
+            logger.warning(f"ignoring rule cache {path} owned by another user")
+            return {}
+        return marshal.load(fp)
+
+
+def write_cache(path, cache):
+    import tempfile
+
+    # a new file avoids following a symlink planted at a predictable path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            marshal.dump(cache, fp)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_path)
+        raise
+
+
+def automaton_to_cache(automaton):
+    # only use builtin types supported by marshal, with arrays as bytes
+    state = {}
+    arrays = {}
+    for name, value in vars(automaton).items():
+        if isinstance(value, array.array):
+            arrays[name] = (value.typecode, value.tobytes())
+        else:
+            state[name] = value
+    state["rules"] = [tuple(rule) for rule in automaton.rules]
+    state["arrays"] = arrays
+    return state
+
+
+def automaton_from_cache(state):
+    automaton = RuleAutomaton.__new__(RuleAutomaton)
+    vars(automaton).update(state)
+    del automaton.arrays
+    for name, (typecode, data) in state["arrays"].items():
+        setattr(automaton, name, array.array(typecode, data))
+    automaton.rules = [Rule(*rule) for rule in state["rules"]]
+    return automaton
+
+
+def read_config(path):
+    """
+    Read rules from a config file.
+
+    Each line has a rule, optionally followed by options, e.g.::
+
+      # caps lock acts as escape when tapped
+      press:capslock,release:capslock=press:esc,release:esc
+
+      # escape acts as caps lock, when grabbing
+      press:esc=press:capslock; consume
+      release:esc=release:capslock; consume
+
+    Empty lines and comments starting with # are ignored.
+    """
+    rule_strings = []
+    with open(path) as fp:
+        for line in fp:
+            line = line.partition("#")[0].strip()
+            if line:
+                rule_strings.append(line)
+    return rule_strings
+
+
+def file_version(path):
+    """
+    Return a value that changes when the file changes.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def rule_keys(rules, attribute):
+    """
+    Return the key codes used in the patterns or actions of rules.
+    """
+    return {
+        decode_key_event(key_event)[0]
+        for rule in rules
+        for key_event in getattr(rule, attribute)
+    }
+
+
+def create_uinput(keys):
+    # tell the uinput device about the exact keys used since the default
+    # value causes events not to propagate to the session somehow; see also
+    # https://gitlab.gnome.org/GNOME/mutter/-/issues/1869
+    import evdev
+
     uinput = evdev.UInput(
-        events={evdev.ecodes.EV_KEY: keys},
+        events={EV_KEY: sorted(keys)},
         name="evcape",
     )
     if uinput.device is None:
@@ -60,44 +708,93 @@ def main():
             f"could not access evdev device for uinput device {uinput.name!r}"
         )
     logger.info(f"created uinput device {uinput.device.path}")
-
-    keyboard_monitor = KeyboardMonitor(ignored_devices=[uinput.device.path])
-
-    # the buffer is as long as the longest sequence in rules
-    window_size = max(len(rule.patterns) for rule in rules)
-    buffer = collections.deque(maxlen=window_size)
-
-    # put keypresses into a buffer and try to match rules
-    previous_event_timestamp = 0.0
-    with uinput, keyboard_monitor:
-        for event in keyboard_monitor:
-            lookup_key = (event.value, event.code)
-            buffer.append(lookup_key)
-            ts_diff = event.timestamp() - previous_event_timestamp
-            previous_event_timestamp = event.timestamp()
-            if ts_diff >= timeout:
-                continue
-            possibly_matching_rules = rules_by_last_event.get(lookup_key)
-            if not possibly_matching_rules:
-                continue
-            for rule in possibly_matching_rules:
-                offset = -len(rule.patterns)
-                buffer_slice = list(buffer)[offset:]
-                if rule.patterns != buffer_slice:
-                    continue
-                for value, code in rule.actions:
-                    uinput.write(evdev.ecodes.EV_KEY, code, value)
-                uinput.syn()
+    return uinput
 
 
 class KeyboardMonitor:
-    def __init__(self, ignored_devices):
-        self.udev_context = pyudev.Context()
+    """
+    Monitor all keyboards, including hotplugged ones.
+
+    Iterating yields (device_state, timestamp, code, value) tuples for key
+    presses and releases, with the timestamp in nanoseconds. The device state
+    is created by calling ``new_device_state`` with the device name and a
+    ``grab`` flag telling whether the device is grabbed when a device is
+    added. When it is dropped, because the device is removed or gets a new
+    state, it is passed to ``drop_device_state``, if set.
+
+    Monitored keyboards are indexed by device path in ``keyboards``, and by
+    device number in ``keyboards_by_number``. Removed keyboards are closed.
+
+    If ``keys`` is given, only devices that can emit at least one of those
+    key codes are monitored.
+
+    Timestamps use CLOCK_MONOTONIC, and call_at() schedules callbacks at such
+    timestamps, which run from the iteration loop, as do callbacks for other
+    file objects registered with add_reader() or add_writer(). The ``on_idle``
+    callback, if set, runs before waiting for new events.
+
+    When the kernel drops events of a keyboard because they were not read
+    in time, the rest of the incomplete frame is skipped, the overflow is
+    counted in ``overflows``, the keyboard gets a fresh device state, and
+    the ``on_resync`` callback, if set, is called with the input device.
+
+    If ``grab`` is set, keyboards are grabbed so that their events only reach
+    evcape, and key repeats are yielded as well, so that they can be
+    forwarded. The paths of grabbed keyboards are kept in
+    ``grabbed_devices``, and their keys are collected in ``grabbed_keys``.
+    Devices whose events cannot all be forwarded are only observed: those
+    that also emit other events than key events, such as mice with keys and
+    touchpads, and if ``forwardable_keys`` is set, keyboards with other keys.
+
+    For testing without hardware, ``udev_monitor`` can replace the udev
+    monitor with an object that has fileno() and poll() methods, in which
+    case existing keyboards are not added, and ``open_input_device`` can
+    replace evdev.InputDevice for opening device paths.
+    """
+
+    def __init__(
+        self,
+        ignored_devices,
+        keys=None,
+        raw=False,
+        grab=False,
+        new_device_state=None,
+        drop_device_state=None,
+        udev_monitor=None,
+        open_input_device=None,
+    ):
         self.selector = selectors.DefaultSelector()
+        self.readers = {}
+        self.writers = {}
         self.ignored_devices = ignored_devices
-        self.input_devices_by_name = set()
-        self.start_udev_monitor()
-        self.add_existing_keyboards()
+        self.keys = keys
+        self.grab = grab
+        self.grabbed_keys = set()
+        self.grabbed_devices = set()
+        self.forwardable_keys = None
+        self.on_idle = None
+        self.on_resync = None
+        self.overflows = 0
+        self.events_read = 0
+        self.repeats_dropped = 0
+        self.new_device_state = new_device_state
+        self.drop_device_state = drop_device_state
+        self.device_states = {}
+        self.timers = []
+        self.timers_compact_size = 64
+        self.raw = raw
+        self.raw_buffer = bytearray(RAW_READ_SIZE)
+        self.keyboards = {}  # device path -> input device
+        self.keyboards_by_number = {}  # dev_t -> input device
+        self.open_input_device = open_input_device
+        if udev_monitor is None:
+            import pyudev
+
+            self.udev_context = pyudev.Context()
+            self.start_udev_monitor()
+            self.add_existing_keyboards()
+        else:
+            self.register(udev_monitor, "udev")
 
     def start_udev_monitor(self):
         """
@@ -105,10 +802,12 @@ class KeyboardMonitor:
 
         This detects when external keyboards are (dis)connected.
         """
+        import pyudev
+
         monitor = pyudev.Monitor.from_netlink(self.udev_context)
         monitor.filter_by(subsystem="input")
         monitor.start()
-        self.selector.register(monitor, events=selectors.EVENT_READ, data="udev")
+        self.register(monitor, "udev")
 
     def add_existing_keyboards(self):
         enumerator = self.udev_context.list_devices()
@@ -120,57 +819,308 @@ class KeyboardMonitor:
                 self.add_keyboard(device_name)
 
     def add_keyboard(self, device_name):
+        """
+        Start monitoring a keyboard, unless it is monitored already.
+
+        Adding a path that is monitored already does nothing, unless the path
+        now refers to another device, which then replaces the previous one.
+        """
         if device_name in self.ignored_devices:
             return
+        previous_input_device = self.keyboards.get(device_name)
+        if previous_input_device is not None:
+            try:
+                device_number = os.stat(device_name).st_rdev
+            except OSError:
+                return  # the device is gone; its removal will follow
+            if device_number == os.fstat(previous_input_device.fd).st_rdev:
+                return
+            self.remove_keyboard(device_name)
+        open_input_device = self.open_input_device
+        if open_input_device is None:
+            import evdev
+
+            open_input_device = evdev.InputDevice
         try:
-            input_device = evdev.InputDevice(device_name)
+            input_device = open_input_device(device_name)
         except OSError as exc:
             logger.warning(f"could not create input device for {device_name}: {exc}")
             return
-        self.selector.register(
-            input_device, events=selectors.EVENT_READ, data="keyboard"
-        )
+        try:
+            device_number = os.fstat(input_device.fd).st_rdev
+            capabilities = input_device.capabilities(absinfo=False)
+        except OSError as exc:
+            logger.warning(f"could not query {device_name}: {exc}")
+            input_device.close()
+            return
+        if device_number in self.keyboards_by_number:
+            logger.debug(
+                "not monitoring {0} again as {1}".format(
+                    self.keyboards_by_number[device_number].path, device_name
+                )
+            )
+            input_device.close()
+            return
+        device_keys = set(capabilities.get(EV_KEY, ()))
+        if self.keys is not None and self.keys.isdisjoint(device_keys):
+            logger.info(
+                "not monitoring {0.path} ({0.name}): "
+                "no keys used by rules".format(input_device)
+            )
+            input_device.close()
+            return
+        grab = self.grab
+        if grab:
+            reason = None
+            if not set(capabilities).issubset(GRABBABLE_EVENT_TYPES):
+                reason = "it also emits other events than key events"
+            elif not (
+                self.forwardable_keys is None
+                or self.forwardable_keys.issuperset(device_keys)
+            ):
+                reason = "the uinput device cannot forward all its keys"
+            if reason is not None:
+                logger.info(
+                    "observing {0.path} ({0.name}) without grabbing it: "
+                    "{1}".format(input_device, reason)
+                )
+                grab = False
+        if grab:
+            self.grabbed_keys.update(device_keys)
+            grab = self.grab_keyboard(input_device)
+        try:
+            fcntl.ioctl(
+                input_device.fd, EVIOCSCLOCKID, struct.pack("i", time.CLOCK_MONOTONIC)
+            )
+        except OSError as exc:
+            logger.warning(f"could not set monotonic clock for {device_name}: {exc}")
+        # only key events are used, so avoid wakeups for e.g. mouse movement
+        # or touchpad events from devices that are also keyboards.
+        try:
+            set_event_type_mask(input_device, [EV_KEY])
+        except OSError as exc:
+            logger.debug(f"could not set event mask for {device_name}: {exc}")
+        self.register(input_device, "keyboard")
+        self.keyboards[device_name] = input_device
+        self.keyboards_by_number[device_number] = input_device
+        if grab:
+            self.grabbed_devices.add(device_name)
+        if self.new_device_state is not None:
+            self.device_states[device_name] = self.new_device_state(
+                device_name, grab=grab
+            )
         logger.info("monitoring {0.path} ({0.name})".format(input_device))
 
+    def grab_keyboard(self, input_device):
+        """
+        Grab a keyboard, and return whether that succeeded right away.
+
+        Grabbing a keyboard while keys are pressed, e.g. the enter key used to
+        start evcape, would make their releases only reach evcape, so that the
+        session would see those keys stuck. In that case, grabbing is retried
+        later, and the keyboard is observed in the meantime.
+        """
+        try:
+            pressed_keys = read_pressed_keys(input_device)
+        except OSError as exc:
+            logger.debug(f"could not read pressed keys of {input_device.path}: {exc}")
+            pressed_keys = 0
+        if pressed_keys:
+            self.call_at(
+                time.monotonic_ns() + GRAB_RETRY_INTERVAL,
+                self.retry_grab_keyboard,
+                input_device,
+            )
+            return False
+        try:
+            input_device.grab()
+        except OSError as exc:
+            logger.warning(f"could not grab {input_device.path}; observing it: {exc}")
+            return False
+        return True
+
+    def retry_grab_keyboard(self, input_device):
+        device_name = input_device.path
+        if self.keyboards.get(device_name) is not input_device:
+            return  # removed in the meantime
+        if not self.grab_keyboard(input_device):
+            return
+        self.grabbed_devices.add(device_name)
+        self.forget_device_state(device_name)
+        if self.new_device_state is not None:
+            self.device_states[device_name] = self.new_device_state(
+                device_name, grab=True
+            )
+        logger.info("grabbed {0.path} ({0.name})".format(input_device))
+
     def remove_keyboard(self, device_name):
-        for selector_key in self.selector.get_map().values():
-            input_device = selector_key.fileobj
-            if not isinstance(input_device, evdev.InputDevice):
-                continue
-            if input_device.path != device_name:
+        input_device = self.keyboards.pop(device_name, None)
+        if input_device is None:
+            return
+        # the device node may be gone, but the open file still refers to it
+        device_number = os.fstat(input_device.fd).st_rdev
+        del self.keyboards_by_number[device_number]
+        self.unregister(input_device)
+        self.forget_device_state(device_name)
+        self.grabbed_devices.discard(device_name)
+        logger.info("no longer monitoring {0.path} ({0.name})".format(input_device))
+        input_device.close()
+
+    def forget_device_state(self, device_name):
+        device_state = self.device_states.pop(device_name, None)
+        if device_state is not None and self.drop_device_state is not None:
+            self.drop_device_state(device_state)
+
+    def input_devices(self):
+        return list(self.keyboards.values())
+
+    def add_reader(self, fileobj, callback):
+        """
+        Call a callback with the file object whenever it is readable.
+        """
+        self.register(fileobj, callback)
+
+    def remove_reader(self, fileobj):
+        self.unregister(fileobj)
+
+    def add_writer(self, fileobj, callback):
+        """
+        Call a callback with the file object whenever it is writable.
+        """
+        self.writers[fileobj] = callback
+        self.selector.register(fileobj, events=selectors.EVENT_WRITE, data=callback)
+
+    def remove_writer(self, fileobj):
+        del self.writers[fileobj]
+        self.selector.unregister(fileobj)
+
+    def register(self, fileobj, data):
+        """
+        Watch a file object; ``data`` is "keyboard", "udev" or a callback.
+        """
+        self.readers[fileobj] = data
+        self.selector.register(fileobj, events=selectors.EVENT_READ, data=data)
+
+    def unregister(self, fileobj):
+        del self.readers[fileobj]
+        self.selector.unregister(fileobj)
+
+    def call_at(self, deadline, callback, *args):
+        """
+        Schedule a callback at a CLOCK_MONOTONIC timestamp in nanoseconds.
+
+        This returns a Timer which can be cancelled.
+        """
+        timer = Timer(deadline, callback, args)
+        timers = self.timers
+        if len(timers) >= self.timers_compact_size:
+            # cancelled timers are only dropped once they are the earliest,
+            # so drop them all when the heap has doubled in size
+            timers[:] = [timer for timer in timers if not timer.cancelled]
+            heapq.heapify(timers)
+            self.timers_compact_size = max(64, 2 * len(timers))
+        heapq.heappush(timers, timer)
+        return timer
+
+    def run_timers(self):
+        """
+        Run due timers, and return the delay until the next one in seconds.
+        """
+        timers = self.timers
+        while timers:
+            timer = timers[0]
+            if timer.cancelled:
+                heapq.heappop(timers)
                 continue
-            self.selector.unregister(input_device)
-            logger.info("no longer monitoring {0.path} ({0.name})".format(input_device))
-            break
+            delay = timer.deadline - time.monotonic_ns()
+            if delay > 0:
+                return delay / 1_000_000_000
+            heapq.heappop(timers)
+            timer.callback(*timer.args)
+        return None
 
     def __iter__(self):
         def read_forever_from_selector():
+            # events that are ready are handled before timers, since their
+            # timestamps may be earlier than the deadline of those timers.
+            # timers scheduled before iterating must not wait for an event.
+            timeout = self.run_timers()
             while True:
-                for selector_key, mask in self.selector.select():
+                for selector_key, mask in self.selector.select(timeout):
                     yield selector_key
+                timeout = self.run_timers()
+                if self.on_idle is not None:
+                    self.on_idle()
 
         for selector_key in read_forever_from_selector():
             if selector_key.data == "keyboard":  # keyboard event
-                input_device = selector_key.fileobj
-                for event in read_input_device_events(input_device):
-                    if event.type != evdev.ecodes.EV_KEY:
-                        continue
-                    if event.value not in KEY_EVENT_VALUE_TO_ACTION:
-                        continue  # e.g. key repeat
-                    yield event
+                yield from self.read_keyboard(selector_key.fileobj)
             elif selector_key.data == "udev":  # hotplug event
-                poll_monitor = functools.partial(selector_key.fileobj.poll, timeout=0)
-                for device in iter(poll_monitor, None):
-                    device_name = udev_keyboard_device_name(device)
-                    if device_name is None:
-                        continue
-                    if device.action == "add":
-                        self.add_keyboard(device_name)
-                    elif device.action == "remove":
-                        self.remove_keyboard(device_name)
+                self.read_udev_monitor(selector_key.fileobj)
+            elif callable(selector_key.data):  # see add_reader()
+                selector_key.data(selector_key.fileobj)
             else:
                 assert False
 
+    def read_keyboard(self, input_device):
+        """
+        Read the pending events of a keyboard.
+        """
+        device_state = self.device_states.get(input_device.path)
+        if self.raw:
+            events = read_raw_input_device_events(input_device, self.raw_buffer)
+        else:
+            events = read_input_device_key_events(input_device)
+        grab = input_device.path in self.grabbed_devices
+        for timestamp, code, value in events:
+            self.events_read += 1
+            if value not in KEY_EVENT_VALUE_TO_ACTION:
+                if code is None:  # events were dropped
+                    device_state = self.resync_keyboard(input_device)
+                    continue
+                if not grab:
+                    self.repeats_dropped += 1
+                    continue  # e.g. key repeat
+            yield device_state, timestamp, code, value
+
+    def resync_keyboard(self, input_device):
+        """
+        Recover from dropped events, and return the new device state.
+
+        The events seen so far cannot be trusted anymore, so matching starts
+        from scratch.
+        """
+        self.overflows += 1
+        logger.warning(
+            f"events from {input_device.path} were dropped because they were "
+            f"not read in time ({self.overflows} overflows so far)"
+        )
+        device_state = None
+        self.forget_device_state(input_device.path)
+        if self.new_device_state is not None:
+            device_state = self.new_device_state(
+                input_device.path, grab=input_device.path in self.grabbed_devices
+            )
+            self.device_states[input_device.path] = device_state
+        if self.on_resync is not None:
+            self.on_resync(input_device)
+        return device_state
+
+    def read_udev_monitor(self, monitor):
+        """
+        Handle pending hotplug events.
+        """
+        poll_monitor = functools.partial(monitor.poll, timeout=0)
+        for device in iter(poll_monitor, None):
+            device_name = udev_keyboard_device_name(device)
+            if device_name is None:
+                continue
+            # adding is idempotent, and a change may make a device relevant
+            if device.action in ("add", "change"):
+                self.add_keyboard(device_name)
+            elif device.action == "remove":
+                self.remove_keyboard(device_name)
+
     def __enter__(self):
         return self
 
@@ -178,11 +1128,970 @@ class KeyboardMonitor:
         self.close()
 
     def close(self):
-        for selector_key in list(self.selector.get_map().values()):
-            self.selector.unregister(selector_key.fileobj)
+        for fileobj in list(self.readers):
+            self.unregister(fileobj)
+        for fileobj in list(self.writers):
+            self.remove_writer(fileobj)
+        for input_device in self.keyboards.values():
+            input_device.close()
+        self.keyboards.clear()
+        self.keyboards_by_number.clear()
+        self.grabbed_devices.clear()
         self.selector.close()
 
 
+class AsyncKeyboardMonitor(KeyboardMonitor):
+    """
+    Keyboard monitor for use with asyncio.
+
+    This works like KeyboardMonitor, but it watches file objects using the
+    event loop instead of its own selector, and events are obtained using
+    ``async for``::
+
+        with AsyncKeyboardMonitor(ignored_devices=[]) as keyboard_monitor:
+            async for device_state, timestamp, code, value in keyboard_monitor:
+                ...
+
+    Pending events are read as soon as the loop sees them, but callbacks
+    scheduled with call_at() run in the iterating task, in order with those
+    events, since the timestamps of events that are ready may be earlier
+    than the deadline of a timer that is due. Callbacks for other file
+    objects registered with add_reader() or add_writer() run directly from
+    the loop.
+
+    This must be created while the event loop is running, unless it is
+    passed as ``loop``.
+    """
+
+    def __init__(self, *args, loop=None, **kwargs):
+        import asyncio
+
+        self.loop = asyncio.get_running_loop() if loop is None else loop
+        self.pending = collections.deque()
+        self.waiter = None
+        self.exception = None
+        super().__init__(*args, **kwargs)
+
+    def register(self, fileobj, data):
+        self.readers[fileobj] = data
+        self.loop.add_reader(fileobj, self.ready, fileobj, data)
+
+    def unregister(self, fileobj):
+        del self.readers[fileobj]
+        self.loop.remove_reader(fileobj)
+
+    def add_writer(self, fileobj, callback):
+        self.writers[fileobj] = callback
+        self.loop.add_writer(fileobj, self.ready, fileobj, callback)
+
+    def remove_writer(self, fileobj):
+        del self.writers[fileobj]
+        self.loop.remove_writer(fileobj)
+
+    def call_at(self, deadline, callback, *args):
+        # the loop clock is CLOCK_MONOTONIC in (fractional) seconds
+        timer = Timer(deadline, callback, args)
+        self.loop.call_at(deadline / 1_000_000_000, self.due, timer)
+        return timer
+
+    def ready(self, fileobj, data):
+        # exceptions are raised from the iterating task, not the loop
+        try:
+            if data == "keyboard":
+                self.pending.extend(self.read_keyboard(fileobj))
+            elif data == "udev":
+                self.read_udev_monitor(fileobj)
+            else:
+                data(fileobj)
+        except Exception as exc:
+            self.exception = exc
+        self.wakeup()
+
+    def due(self, timer):
+        self.pending.append(timer)
+        self.wakeup()
+
+    def wakeup(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def __aiter__(self):
+        pending = self.pending
+        while True:
+            while pending:
+                item = pending.popleft()
+                if type(item) is Timer:
+                    if not item.cancelled:
+                        item.callback(*item.args)
+                    continue
+                yield item
+            if self.exception is not None:
+                exception, self.exception = self.exception, None
+                raise exception
+            if self.on_idle is not None:
+                self.on_idle()
+            self.waiter = self.loop.create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+
+    def __iter__(self):
+        raise TypeError("use 'async for' with an AsyncKeyboardMonitor")
+
+
+class ControlServer:
+    """
+    Unix domain socket server to inspect and control a running evcape.
+
+    Clients send a single line with a command name, and receive the result
+    of the corresponding callable in ``commands`` as JSON, after which the
+    connection is closed.
+
+    All sockets are non-blocking and served from the selector of the
+    keyboard monitor. Each wakeup accepts at most one connection, reads at
+    most one chunk of a request or writes at most one chunk of a response,
+    and the number of connections is limited, so that clients cannot delay
+    the processing of key events.
+    """
+
+    max_clients = 4
+    max_request_size = 256
+    max_send_size = 65536
+
+    def __init__(self, path, keyboard_monitor, commands):
+        self.path = path
+        self.keyboard_monitor = keyboard_monitor
+        self.commands = commands
+        self.clients = {}
+        self.responses = {}  # client -> unsent part of the response
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.setblocking(False)
+        self.socket.bind(path)
+        os.chmod(path, 0o600)
+        self.socket.listen(self.max_clients)
+        keyboard_monitor.add_reader(self.socket, self.accept)
+
+    def accept(self, sock):
+        try:
+            client, _ = sock.accept()
+        except BlockingIOError:
+            return
+        if len(self.clients) >= self.max_clients:
+            client.close()
+            return
+        client.setblocking(False)
+        self.clients[client] = bytearray()
+        self.keyboard_monitor.add_reader(client, self.read)
+
+    def read(self, client):
+        request = self.clients[client]
+        try:
+            chunk = client.recv(self.max_request_size)
+        except BlockingIOError:
+            return
+        except OSError:
+            chunk = b""
+        request += chunk
+        if chunk and b"\n" not in request and len(request) < self.max_request_size:
+            return  # incomplete request
+        if chunk:
+            command = request.partition(b"\n")[0].decode(errors="replace").strip()
+            try:
+                if command not in self.commands:
+                    raise ValueError(f"unknown command {command!r}")
+                response = {"result": self.commands[command]()}
+            except Exception as exc:
+                logger.warning(f"control command {command!r} failed: {exc}")
+                response = {"error": str(exc)}
+            self.keyboard_monitor.remove_reader(client)
+            self.responses[client] = memoryview(json.dumps(response).encode() + b"\n")
+            self.keyboard_monitor.add_writer(client, self.write)
+            return
+        self.close_client(client)
+
+    def write(self, client):
+        response = self.responses[client]
+        try:
+            sent = client.send(response[: self.max_send_size])
+        except BlockingIOError:
+            return
+        except OSError:
+            sent = len(response)  # the client is gone; not our problem
+        response = self.responses[client] = response[sent:]
+        if not response:
+            self.close_client(client)
+
+    def close_client(self, client):
+        if self.responses.pop(client, None) is None:
+            self.keyboard_monitor.remove_reader(client)
+        else:
+            self.keyboard_monitor.remove_writer(client)
+        del self.clients[client]
+        client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for client in list(self.clients):
+            self.close_client(client)
+        self.keyboard_monitor.remove_reader(self.socket)
+        self.socket.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+
+class FrameWriter:
+    """
+    Writer for frames of key events to an uinput device.
+
+    Events are packed into a preallocated buffer, and flush() terminates the
+    frame with a SYN_REPORT and writes it using a single system call.
+
+    The timestamp passed to add() is the (kernel) timestamp of the input event
+    causing the output. If ``latency`` is set to a LatencyHistogram, the
+    delay between the earliest such timestamp in a frame and the moment the
+    frame is written is added to it.
+    """
+
+    def __init__(self, fd, capacity=16):
+        self.fd = fd
+        self.buffer = bytearray(capacity * INPUT_EVENT.size)
+        self.size = 0
+        self.latency = None
+        self.input_timestamp = 0
+        self.frames_written = 0
+
+    def add(self, code, value, timestamp=0):
+        self._pack(EV_KEY, code, value)
+        if not self.input_timestamp:
+            self.input_timestamp = timestamp
+
+    def flush(self):
+        if not self.size:
+            return
+        self._pack(EV_SYN, SYN_REPORT, 0)
+        os.write(self.fd, memoryview(self.buffer)[: self.size])
+        self.size = 0
+        self.frames_written += 1
+        if self.latency is not None and self.input_timestamp:
+            self.latency.add(time.monotonic_ns() - self.input_timestamp)
+        self.input_timestamp = 0
+
+    def _pack(self, type, code, value):
+        if self.size + INPUT_EVENT.size > len(self.buffer):
+            self.buffer.extend(bytes(len(self.buffer)))
+        INPUT_EVENT.pack_into(self.buffer, self.size, 0, 0, type, code, value)
+        self.size += INPUT_EVENT.size
+
+
+class PrintWriter:
+    """
+    Writer that prints frames of key events instead of writing them.
+
+    Each frame is printed on a line, prefixed by the time in seconds (of
+    ``timestamp`` relative to ``start_timestamp``), e.g.::
+
+      1.234567 press:esc,release:esc
+    """
+
+    def __init__(self):
+        self.key_events = []
+        self.start_timestamp = 0
+        self.timestamp = 0
+        self.count = 0
+
+    def add(self, code, value, timestamp=0):
+        self.key_events.append((code, value))
+
+    def flush(self):
+        if not self.key_events:
+            return
+        offset = (self.timestamp - self.start_timestamp) / 1_000_000_000
+        print(f"{offset:.6f} {format_key_events(self.key_events)}")
+        self.key_events.clear()
+        self.count += 1
+
+
+class TraceWriter:
+    """
+    Writer for traces of key events.
+
+    A trace starts with TRACE_MAGIC, followed by a record per event, which
+    consists of these unsigned LEB128 varints:
+
+    - the difference with the timestamp of the previous event (or 0) in
+      microseconds, zigzag encoded since events from different devices may
+      be slightly out of order;
+    - the device index, with devices numbered in order of appearance; for
+      the first event of a device, this is followed by the length of the
+      device name and the utf-8 encoded name itself;
+    - the key code and value, encoded as code << 2 | value.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.device_indices = {}
+        self.previous_timestamp = 0
+        self.count = 0
+        fp.write(TRACE_MAGIC)
+
+    def write(self, device_name, timestamp, code, value):
+        out = bytearray()
+        timestamp //= 1000
+        delta = timestamp - self.previous_timestamp
+        self.previous_timestamp = timestamp
+        write_varint(out, delta << 1 if delta >= 0 else ~delta << 1 | 1)
+        device_index = self.device_indices.get(device_name)
+        if device_index is None:
+            device_index = self.device_indices[device_name] = len(self.device_indices)
+            write_varint(out, device_index)
+            name = device_name.encode()
+            write_varint(out, len(name))
+            out += name
+        else:
+            write_varint(out, device_index)
+        write_varint(out, code << 2 | value)
+        self.fp.write(out)
+        self.count += 1
+
+
+def read_trace(fp):
+    """
+    Read a trace written by TraceWriter.
+
+    This yields (device_name, timestamp, code, value) tuples.
+    """
+    data = fp.read()
+    if not data.startswith(TRACE_MAGIC):
+        raise ValueError("not an evcape trace")
+    position = len(TRACE_MAGIC)
+    device_names = []
+    timestamp = 0
+    while position < len(data):
+        delta, position = read_varint(data, position)
+        timestamp += -(delta >> 1) - 1 if delta & 1 else delta >> 1
+        device_index, position = read_varint(data, position)
+        if device_index == len(device_names):
+            length, position = read_varint(data, position)
+            device_names.append(data[position : position + length].decode())
+            position += length
+        key, position = read_varint(data, position)
+        yield device_names[device_index], timestamp * 1000, key >> 2, key & 3
+
+
+def write_varint(out, n):
+    while n > 0x7F:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def read_varint(data, position):
+    n = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, position
+        shift += 7
+
+
+class Timer:
+    """
+    Callback scheduled with KeyboardMonitor.call_at().
+    """
+
+    __slots__ = ("deadline", "callback", "args", "cancelled")
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Matcher:
+    """
+    Rule matching engine, using a compiled RuleAutomaton.
+
+    Key events are passed to feed(), together with the matching state for
+    the device they originate from, as created by new_state(). Actions of
+    matching rules, and when grabbing all events not consumed by a rule, are
+    written to ``writer``, which should be a FrameWriter or similar.
+
+    If ``call_at`` is set to a scheduling function like
+    KeyboardMonitor.call_at(), partially matched sequences expire at their
+    deadline; otherwise they only expire once the next event arrives. The
+    scheduled callbacks compare deadlines with ``clock``, which returns the
+    CLOCK_MONOTONIC time in nanoseconds, unless replaced by another clock.
+
+    If ``queue_latency`` is set to a LatencyHistogram, the delay between the
+    timestamp of each event and the moment it is fed is added to it.
+
+    The number of matches for each rule is counted in ``rule_hits``.
+
+    The pressed keys of each device are tracked in its state, and those of
+    all devices are combined in ``pressed``, for rule conditions; for each
+    key, ``key_counts`` has the number of states in which it is pressed.
+    Device states that are no longer used must be passed to drop_state(), so
+    that their keys no longer count as pressed.
+
+    When grabbing, the events of devices that are not grabbed are matched,
+    but not forwarded, since they reach the session anyway; their states
+    are created using new_state() with ``grab=False``.
+    """
+
+    def __init__(self, automaton, timeout, writer=None, grab=False, shared_state=False):
+        self.timeout = timeout
+        self.set_automaton(automaton)
+        self.writer = writer
+        self.grab = grab
+        self.pressed = 0
+        self.key_counts = [0] * KEY_CNT
+        self.shared_state = None
+        self.observed_shared_state = None
+        if shared_state:
+            self.shared_state = self.new_state()
+        self.call_at = None
+        self.clock = time.monotonic_ns
+        self.queue_latency = None
+
+    def set_automaton(self, automaton):
+        """
+        Replace the automaton, and hence the rules.
+
+        States that were created for the previous automaton are reset as soon
+        as they are used.
+        """
+        self.rule_hits = [0] * len(automaton.rules)
+        # the step timeout for each state, in nanoseconds, taking the global
+        # timeout into account
+        self.step_timeouts = array.array(
+            "q",
+            (
+                max(step_timeout, self.timeout) if default_step else step_timeout
+                for step_timeout, default_step in zip(
+                    automaton.step_timeouts, automaton.default_steps
+                )
+            ),
+        )
+        self.automaton = automaton
+
+    def new_state(self, device_name=None, grab=True):
+        """
+        Create matching state for a device.
+
+        With shared state, devices that are not grabbed while grabbing share
+        a state of their own.
+        """
+        grab = self.grab and grab
+        if self.shared_state is not None:
+            if grab == self.shared_state.grab:
+                return self.shared_state
+            if self.observed_shared_state is None:
+                self.observed_shared_state = MatchState(self.automaton, grab)
+            return self.observed_shared_state
+        return MatchState(self.automaton, grab)
+
+    def drop_state(self, device_state):
+        """
+        Forget the state of a device that is removed or gets a new state.
+
+        Its keys no longer count as pressed, and its held chord keys and
+        counted taps are discarded, even if timers still refer to it. Shared
+        states are kept, since other devices use them.
+        """
+        if device_state is self.shared_state:
+            return
+        if device_state is self.observed_shared_state:
+            return
+        self.set_pressed(device_state, 0)
+        device_state.chord_pending = []
+        device_state.tap_code = None
+
+    def set_pressed(self, device_state, pressed):
+        """
+        Set the pressed keys of a device state, as a bitset.
+        """
+        key_counts = self.key_counts
+        for code in iter_bits(pressed & ~device_state.pressed):
+            key_counts[code] += 1
+            self.pressed |= 1 << code
+        for code in iter_bits(device_state.pressed & ~pressed):
+            key_counts[code] -= 1
+            if not key_counts[code]:
+                self.pressed &= ~(1 << code)
+        device_state.pressed = pressed
+
+    def feed(self, device_state, timestamp, code, value):
+        """
+        Feed a key event into the matcher.
+
+        The events are matched against the sequence of events that ends with
+        this event, and the actions of the rules matching it are performed.
+        When grabbing, the event is forwarded unless consumed by a matching
+        rule; forwarded events are only written once a rule matches or when
+        the writer is flushed.
+        """
+        if self.queue_latency is not None:
+            self.queue_latency.add(time.monotonic_ns() - timestamp)
+        writer = self.writer
+        if value == 2:  # key repeat, only passed when grabbing
+            if device_state.chord_pending:
+                self.flush_chords(device_state)
+            writer.add(code, value, timestamp)
+            return
+        automaton = self.automaton
+        if automaton.chords and self.feed_chords(device_state, timestamp, code, value):
+            return
+        bit = 1 << code
+        if value:
+            if not device_state.pressed & bit:
+                device_state.pressed |= bit
+                self.key_counts[code] += 1
+                self.pressed |= bit
+        elif device_state.pressed & bit:
+            device_state.pressed ^= bit
+            key_counts = self.key_counts
+            key_counts[code] -= 1
+            if not key_counts[code]:
+                self.pressed &= ~bit
+        if device_state.automaton is not automaton:
+            device_state.reset(automaton)
+        tapped = False
+        if automaton.taps:
+            tapped = self.feed_taps(device_state, timestamp, code, value)
+        if automaton.history:
+            position = device_state.position
+            device_state.timestamps[position] = timestamp
+            device_state.position = (position + 1) & (automaton.history - 1)
+        symbol = automaton.symbols[code << 1 | value]
+        ts_diff = timestamp - device_state.previous_timestamp
+        device_state.previous_timestamp = timestamp
+        if ts_diff >= self.step_timeouts[device_state.state]:
+            # too slow; this event can only start a new sequence, which may
+            # complete patterns consisting of a single event
+            state = automaton.transitions[symbol]
+        else:
+            state = automaton.transitions[device_state.state * automaton.width + symbol]
+        device_state.state = state
+        matching_rules = automaton.accepts[state]
+        if (
+            state != automaton.initial_state
+            and device_state.timer is None
+            and self.call_at is not None
+        ):
+            device_state.timer = self.call_at(
+                timestamp + self.step_timeouts[state], self.expire, device_state
+            )
+        consume = automaton.consumes[state]
+        if automaton.checked[state]:
+            matching_rules, consume = self.check_rules(
+                device_state, matching_rules, code
+            )
+        if not matching_rules:
+            if device_state.grab:
+                writer.add(code, value, timestamp)
+            if tapped:
+                self.resolve_taps(device_state, timestamp)
+            return
+        if device_state.grab and not consume:
+            writer.add(code, value, timestamp)
+        rules = automaton.rules
+        rule_hits = self.rule_hits
+        for index in matching_rules:
+            rule_hits[index] += 1
+            for key_event in rules[index].actions:
+                writer.add(*decode_key_event(key_event), timestamp)
+        if tapped:
+            self.resolve_taps(device_state, timestamp)
+        writer.flush()
+
+    def feed_chords(self, device_state, timestamp, code, value):
+        """
+        Match chords, and return whether the event is consumed or held.
+
+        When grabbing, presses of keys used by consuming chords are held
+        until they turn out not to complete a chord, which is the case once
+        another event arrives or the chord timeout passes; they are then fed
+        again in their original order.
+        """
+        pending = device_state.chord_pending
+        if pending is None:
+            return False  # feeding held events again
+        automaton = self.automaton
+        chord_rules = automaton.chords.get(code)
+        if pending and (
+            chord_rules is None
+            or not value
+            or timestamp - pending[0][0] >= automaton.chord_timeout
+        ):
+            self.flush_chords(device_state)
+        if chord_rules is None:
+            return False
+        bit = 1 << code
+        presses = device_state.chord_presses
+        if not value:
+            presses.pop(code, None)
+            if device_state.chord_consumed & bit:
+                # the press was consumed by a chord, so the release is too
+                device_state.chord_consumed &= ~bit
+                if device_state.grab:
+                    self.set_pressed(device_state, device_state.pressed & ~bit)
+                    return True
+            return False
+
+        presses[code] = timestamp
+        pressed = device_state.pressed | bit
+        consume = False
+        for index in chord_rules:
+            mask = automaton.chord_masks[index]
+            if pressed & mask != mask:
+                continue
+            first = min(presses.get(key, -1 << 62) for key in iter_bits(mask))
+            if timestamp - first >= automaton.chord_timeouts[index]:
+                continue
+            consume |= self.fire_chord(device_state, index, timestamp)
+        if consume:
+            self.set_pressed(device_state, pressed)
+            return True
+        if device_state.grab and automaton.chord_holds & bit:
+            device_state.chord_pending.append((timestamp, code, value))
+            self.set_pressed(device_state, pressed)
+            if device_state.chord_timer is None and self.call_at is not None:
+                device_state.chord_timer = self.call_at(
+                    timestamp + automaton.chord_timeout,
+                    self.expire_chords,
+                    device_state,
+                )
+            return True
+        return False
+
+    def fire_chord(self, device_state, index, timestamp):
+        """
+        Perform the actions of a chord, and return whether it consumes.
+        """
+        rule = self.automaton.rules[index]
+        mask = self.automaton.chord_masks[index]
+        for key in iter_bits(mask):
+            device_state.chord_presses.pop(key, None)
+        consume = device_state.grab and rule.consume
+        if consume:
+            # drop the held presses of the chord keys, and forward the others
+            device_state.chord_pending = [
+                event
+                for event in device_state.chord_pending
+                if not mask >> event[1] & 1
+            ]
+            device_state.chord_consumed |= mask
+        self.flush_chords(device_state)
+        self.rule_hits[index] += 1
+        for key_event in rule.actions:
+            self.writer.add(*decode_key_event(key_event), timestamp)
+        self.writer.flush()
+        return consume
+
+    def flush_chords(self, device_state):
+        """
+        Feed held events again, now that they are not part of a chord.
+
+        Since those presses are forwarded, they cannot be consumed by a chord
+        anymore.
+        """
+        pending = device_state.chord_pending
+        if not pending:
+            return
+        device_state.chord_pending = None
+        try:
+            for event in pending:
+                device_state.chord_presses.pop(event[1], None)
+                self.feed(device_state, *event)
+        finally:
+            device_state.chord_pending = []
+
+    def expire_chords(self, device_state):
+        device_state.chord_timer = None
+        pending = device_state.chord_pending
+        if not pending:
+            return
+        deadline = pending[0][0] + self.automaton.chord_timeout
+        if deadline > self.clock():
+            device_state.chord_timer = self.call_at(
+                deadline, self.expire_chords, device_state
+            )
+        else:
+            self.flush_chords(device_state)
+            self.writer.flush()
+
+    def feed_taps(self, device_state, timestamp, code, value):
+        """
+        Count taps, and return whether the last tap counted is the final one.
+
+        Taps of a key are counted until the longest window of its tap rules
+        passes, another key is pressed, or the highest count used by its
+        rules is reached; the taps are then resolved, which performs the
+        actions of the rules for the number of taps counted. The final tap
+        is resolved by the caller, after its release has been forwarded.
+        """
+        automaton = self.automaton
+        tap_code = device_state.tap_code
+        if tap_code is not None and (
+            (value and code != tap_code)
+            or timestamp - device_state.tap_start >= automaton.tap_windows[tap_code]
+        ):
+            self.resolve_taps(device_state, timestamp)
+            tap_code = None
+        if value:
+            if tap_code is None and code in automaton.taps:
+                device_state.tap_code = code
+                device_state.tap_count = 0
+                device_state.tap_start = timestamp
+                if device_state.tap_timer is None and self.call_at is not None:
+                    device_state.tap_timer = self.call_at(
+                        timestamp + automaton.tap_windows[code],
+                        self.expire_taps,
+                        device_state,
+                    )
+            return False
+        if code != tap_code:
+            return False
+        device_state.tap_count += 1
+        device_state.tap_end = timestamp
+        return device_state.tap_count == automaton.tap_counts[code]
+
+    def resolve_taps(self, device_state, timestamp):
+        """
+        Perform the actions of the tap rules matching the counted taps.
+        """
+        automaton = self.automaton
+        indices = automaton.taps[device_state.tap_code].get(device_state.tap_count)
+        device_state.tap_code = None
+        if indices is None:
+            return
+        duration = device_state.tap_end - device_state.tap_start
+        for index in indices:
+            if duration >= automaton.tap_timeouts[index]:
+                continue
+            self.rule_hits[index] += 1
+            for key_event in automaton.rules[index].actions:
+                self.writer.add(*decode_key_event(key_event), timestamp)
+        self.writer.flush()
+
+    def expire_taps(self, device_state):
+        device_state.tap_timer = None
+        if (
+            device_state.tap_code is None
+            or device_state.automaton is not self.automaton
+        ):
+            return
+        deadline = (
+            device_state.tap_start + self.automaton.tap_windows[device_state.tap_code]
+        )
+        if deadline > self.clock():
+            device_state.tap_timer = self.call_at(
+                deadline, self.expire_taps, device_state
+            )
+        else:
+            self.resolve_taps(device_state, deadline)
+
+    def check_rules(self, device_state, matching_rules, code):
+        """
+        Select the matching rules whose conditions and timeouts hold.
+
+        This returns the selected rules, and whether any of those consumes
+        the event.
+        """
+        automaton = self.automaton
+        rules = automaton.rules
+        other_keys = None
+        selected = []
+        for index in matching_rules:
+            rule = rules[index]
+            if rule.condition is not None:
+                if other_keys is None:
+                    other_keys = self.pressed & ~(1 << code)
+                if other_keys & ~RULE_CONDITIONS[rule.condition]:
+                    continue
+            if automaton.history and not self.check_timeouts(device_state, rule):
+                continue
+            selected.append(index)
+        consume = any(rules[index].consume for index in selected)
+        return tuple(selected), consume
+
+    def check_timeouts(self, device_state, rule):
+        """
+        Check the timestamps of the events matching the pattern of a rule.
+        """
+        timestamps = device_state.timestamps
+        mask = len(timestamps) - 1
+        last = device_state.position - 1
+        first = last - len(rule.patterns) + 1
+        step = self.timeout if rule.step is None else rule.step * 1_000_000
+        for position in range(first, last):
+            if timestamps[(position + 1) & mask] - timestamps[position & mask] >= step:
+                return False
+        if rule.within is not None:
+            duration = timestamps[last & mask] - timestamps[first & mask]
+            if duration >= rule.within * 1_000_000:
+                return False
+        return True
+
+    def expire(self, device_state):
+        # reset a partially matched sequence once its deadline has passed,
+        # unless a later event moved the deadline. states of a previous
+        # automaton are reset when they are used next.
+        if device_state.automaton is not self.automaton:
+            device_state.timer = None
+            return
+        deadline = (
+            device_state.previous_timestamp + self.step_timeouts[device_state.state]
+        )
+        if deadline > self.clock():
+            device_state.timer = self.call_at(deadline, self.expire, device_state)
+        else:
+            device_state.timer = None
+            device_state.state = self.automaton.initial_state
+
+
+class LatencyHistogram:
+    """
+    Histogram of latencies with fixed buckets.
+
+    Latencies are given in nanoseconds, but kept in microseconds. Below 16µs
+    each microsecond has its own bucket; above that, each power of two is
+    split into 8 buckets, so that percentiles are accurate to within 12.5%.
+    """
+
+    # enough buckets for latencies up to 2**31µs (about 35 minutes)
+    n_buckets = 240
+
+    def __init__(self):
+        self.counts = array.array("Q", [0]) * self.n_buckets
+        self.count = 0
+        self.max = 0
+
+    def add(self, latency):
+        latency = max(latency, 0) // 1000
+        self.count += 1
+        if latency > self.max:
+            self.max = latency
+        if latency < 16:
+            index = latency
+        else:
+            shift = latency.bit_length() - 4
+            index = min(shift * 8 + (latency >> shift), self.n_buckets - 1)
+        self.counts[index] += 1
+
+    def percentile(self, p):
+        """
+        Return the (upper bound of the) p-th percentile in microseconds.
+        """
+        threshold = self.count * p / 100
+        total = 0
+        for index, count in enumerate(self.counts):
+            total += count
+            if total >= threshold and count:
+                if index < 16:
+                    return index
+                shift = index // 8 - 1
+                upper_bound = ((index % 8 + 9) << shift) - 1
+                return min(upper_bound, self.max)
+        return 0
+
+    def as_dict(self):
+        return {
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max,
+            "count": self.count,
+        }
+
+    def summary(self):
+        return (
+            f"p50 {self.percentile(50)}µs, p99 {self.percentile(99)}µs, "
+            f"max {self.max}µs ({self.count} events)"
+        )
+
+
+class MatchState:
+    """
+    Matching state for one keyboard (or for all keyboards, if shared).
+
+    If ``grab`` is set, the events of the keyboard are forwarded, unless
+    consumed by a rule.
+
+    The keys that are currently pressed are kept as a bitset in ``pressed``.
+    If the automaton has rules with timeouts, the timestamps of the latest
+    events are kept in ``timestamps``, a ring buffer, with ``position`` as
+    the index for the next event.
+
+    For chords, ``chord_presses`` has the press timestamps of chord keys,
+    ``chord_pending`` has the (timestamp, code, value) events that are held
+    when grabbing, and ``chord_consumed`` is the bitset of keys whose presses
+    were consumed by a chord, so that their releases are consumed as well.
+
+    For tap rules, ``tap_code`` is the key whose taps are being counted, if
+    any, ``tap_count`` the number of completed taps, and ``tap_start`` and
+    ``tap_end`` the timestamps of the first press and the last release.
+    """
+
+    __slots__ = (
+        "automaton",
+        "grab",
+        "state",
+        "previous_timestamp",
+        "timer",
+        "pressed",
+        "timestamps",
+        "position",
+        "chord_presses",
+        "chord_pending",
+        "chord_consumed",
+        "chord_timer",
+        "tap_code",
+        "tap_count",
+        "tap_start",
+        "tap_end",
+        "tap_timer",
+    )
+
+    def __init__(self, automaton, grab=False):
+        self.grab = grab
+        self.previous_timestamp = 0
+        self.timer = None
+        self.pressed = 0
+        self.chord_presses = {}
+        self.chord_pending = []
+        self.chord_consumed = 0
+        self.chord_timer = None
+        self.tap_timer = None
+        self.reset(automaton)
+
+    def reset(self, automaton):
+        self.automaton = automaton
+        self.state = automaton.initial_state
+        # ring buffer with the timestamps of the latest events
+        self.timestamps = array.array("q", bytes(8 * automaton.history))
+        self.position = 0
+        self.tap_code = None
+        self.tap_count = 0
+        self.tap_start = self.tap_end = 0
+
+
 def read_input_device_events(input_device):
     try:
         yield from input_device.read()
@@ -193,6 +2102,127 @@ def read_input_device_events(input_device):
             raise
 
 
+def encode_key_event(code, value):
+    return code << 1 | value
+
+
+def decode_key_event(key_event):
+    return key_event >> 1, key_event & 1
+
+
+def read_input_device_key_events(input_device):
+    """
+    Read key events as (timestamp, code, value) tuples.
+
+    A (timestamp, None, None) tuple signals that the kernel dropped events.
+    """
+    events = read_input_device_events(input_device)
+    for event in events:
+        if event.type == EV_KEY:
+            timestamp = event.sec * 1_000_000_000 + event.usec * 1000
+            yield timestamp, event.code, event.value
+        elif event.type == EV_SYN and event.code == SYN_DROPPED:
+            skip_dropped_frame((event.type, event.code) for event in events)
+            yield event.sec * 1_000_000_000 + event.usec * 1000, None, None
+
+
+def read_raw_input_device_events(input_device, buffer):
+    """
+    Read key events directly from the device node.
+
+    This reads into a preallocated buffer and decodes the raw input_event
+    structs, which avoids creating evdev.InputEvent objects. This yields
+    (timestamp, code, value) tuples, like read_input_device_key_events(),
+    including the (timestamp, None, None) tuples for dropped events.
+    """
+    try:
+        size = os.readv(input_device.fd, [buffer])
+    except BlockingIOError:
+        return
+    except OSError as exc:
+        if exc.errno == errno.ENODEV:
+            return  # Device has disappeared.
+        raise
+    events = INPUT_EVENT.iter_unpack(memoryview(buffer)[:size])
+    for sec, usec, type, code, value in events:
+        if type == EV_KEY:
+            yield sec * 1_000_000_000 + usec * 1000, code, value
+        elif type == EV_SYN and code == SYN_DROPPED:
+            skip_dropped_frame((type, code) for _, _, type, code, _ in events)
+            yield sec * 1_000_000_000 + usec * 1000, None, None
+
+
+def skip_dropped_frame(events):
+    """
+    Skip the rest of the frame following a SYN_DROPPED event.
+
+    The events up to the next SYN_REPORT are an incomplete frame, which the
+    kernel queues together with the SYN_DROPPED event, so it is part of the
+    same read. The ``events`` are (type, code) tuples.
+    """
+    for type, code in events:
+        if type == EV_SYN and code == SYN_REPORT:
+            break
+
+
+def read_pressed_keys(input_device):
+    """
+    Return the keys that are currently pressed on a device as a bitset.
+    """
+    bits = array.array("L", bytes(KEY_CNT // 8))
+    fcntl.ioctl(input_device.fd, EVIOCGKEY, bits)
+    pressed = 0
+    for index, item in enumerate(bits):
+        pressed |= item << (index * 8 * bits.itemsize)
+    return pressed
+
+
+def set_event_type_mask(input_device, types):
+    """
+    Make the kernel only deliver events of the given types for this device.
+
+    EV_SYN events are always delivered, but the kernel drops SYN_REPORT
+    events for frames without any unmasked events, so those do not cause
+    wakeups either. This requires linux 4.4 or newer.
+    """
+    bits_per_item = 8 * array.array("L").itemsize
+    bits = array.array("L", [0]) * -(-EV_CNT // bits_per_item)
+    for type in types:
+        bits[type // bits_per_item] |= 1 << (type % bits_per_item)
+    address, length = bits.buffer_info()
+    mask = INPUT_MASK.pack(0, length * bits.itemsize, address)
+    fcntl.ioctl(input_device.fd, EVIOCSMASK, mask)
+
+
+def format_key_events(key_events):
+    """
+    Format (code, value) pairs using the rule syntax, e.g. press:esc.
+    """
+    out = []
+    for code, value in key_events:
+        name = KEY_NAMES.get(code, str(code))
+        action = KEY_EVENT_VALUE_TO_ACTION.get(value, "repeat")
+        out.append(f"{action}:{name}")
+    return ",".join(out)
+
+
+def format_keys(keys):
+    """
+    Format a bitset of key codes as a list of key names.
+    """
+    return [KEY_NAMES.get(code, str(code)) for code in iter_bits(keys)]
+
+
+def iter_bits(bits):
+    """
+    Yield the positions of the bits that are set, from low to high.
+    """
+    while bits:
+        lowest_bit = bits & -bits
+        yield lowest_bit.bit_length() - 1
+        bits ^= lowest_bit
+
+
 def udev_keyboard_device_name(device):
     if device.properties.get("ID_INPUT_KEYBOARD") != "1":
         return None  # This is not a keyboard.
@@ -202,7 +2232,11 @@ def udev_keyboard_device_name(device):
         return None
 
 
-_Rule = collections.namedtuple("Rule", ["patterns", "actions"])
+_Rule = collections.namedtuple(
+    "Rule",
+    ["patterns", "actions", "consume", "condition", "within", "step", "kind"],
+    defaults=[False, None, None, None, "sequence"],
+)
 
 
 class Rule(_Rule):
@@ -218,8 +2252,10 @@ class Rule(_Rule):
         Sample output:
 
           Rule(
-              patterns=[(1, 29), (0, 29)],
-              actions=[(1, 1), (0, 1)])
+              patterns=[59, 58],
+              actions=[3, 2])
+
+        Each key event is encoded as code * 2 + value.
 
         Key codes:
 
@@ -230,10 +2266,69 @@ class Rule(_Rule):
 
           press == 1
           release == 0
+
+        Options can be appended after a semicolon:
+
+          press:capslock=press:esc;consume
+
+        With the consume option, the event completing the pattern is not
+        forwarded when keyboards are grabbed.
+
+        With the alone option, the rule only matches if no other keys are
+        pressed (on any keyboard) than the key of the event completing the
+        pattern; with the mods-only option, only modifiers may be pressed
+        besides that key.
+
+        Timeouts in milliseconds can be set per rule, instead of using the
+        global timeout:
+
+          press:leftshift,release:leftshift=press:esc,release:esc;within=200
+
+        With within=N, the whole pattern must be completed within N ms; with
+        step=N, each event of the pattern must follow the previous event
+        within N ms, which is what the global timeout applies to otherwise.
+
+        Instead of a sequence, the pattern can be a chord of keys that are
+        pressed at the same time, in any order:
+
+          chord:j+k=press:esc,release:esc;within=50
+
+        The pattern of a chord is stored as the press events of its keys.
+        All keys must be pressed within the given time, which is 50 ms by
+        default. When keyboards are grabbed, the keys of chords with the
+        consume option are only forwarded once it is clear that they are
+        not part of a chord.
+
+        The pattern can also be a number of taps of a single key:
+
+          tap:leftshift*2=press:capslock,release:capslock;within=300
+
+        The pattern of a tap rule is stored as the press and release events
+        of its taps. All taps must be completed within the given time, which
+        is 250 ms by default. Taps are counted until that time has passed,
+        another key is pressed, or the highest count used by the tap rules
+        for the key is reached, so that e.g. single and double taps can be
+        told apart.
         """
+        s, *options = (part.strip() for part in s.split(";"))
         patterns, _, actions = s.partition("=")
+        options = cls.parse_options(options)
+        if patterns.startswith("chord:"):
+            if "condition" in options or "step" in options:
+                raise ValueError(f"chord rules only support consume and within: {s}")
+            options["kind"] = "chord"
+            patterns = cls.parse_chord(patterns[len("chord:") :])
+        elif patterns.startswith("tap:"):
+            if set(options) - {"within"}:
+                raise ValueError(f"tap rules only support within: {s}")
+            options["kind"] = "tap"
+            patterns = cls.parse_tap(patterns[len("tap:") :])
+        else:
+            patterns = cls.parse_sequence(patterns)
         return cls(
-            patterns=cls.parse_sequence(patterns), actions=cls.parse_sequence(actions)
+            patterns=patterns,
+            actions=cls.parse_sequence(actions),
+            **options,
         )
 
     @staticmethod
@@ -241,11 +2336,356 @@ class Rule(_Rule):
         out = []
         for chunk in s.split(","):
             action, _, key = chunk.partition(":")
-            value = ACTION_TO_KEY_EVENT_VALUE[action]
-            code = getattr(evdev.ecodes, f"KEY_{key.upper()}")
-            out.append((value, code))
+            try:
+                value = ACTION_TO_KEY_EVENT_VALUE[action]
+                code = KEY_CODES[key.lower()]
+            except KeyError:
+                raise ValueError(f"invalid key event {chunk!r}") from None
+            out.append(encode_key_event(code, value))
+        return out
+
+    @staticmethod
+    def parse_chord(s):
+        codes = []
+        for key in s.split("+"):
+            code = KEY_CODES.get(key.lower())
+            if code is None or code in codes:
+                raise ValueError(f"invalid chord key {key!r}")
+            codes.append(code)
+        if len(codes) < 2:
+            raise ValueError(f"chord {s!r} needs at least two keys")
+        return [encode_key_event(code, 1) for code in codes]
+
+    @staticmethod
+    def parse_tap(s):
+        key, _, count = s.partition("*")
+        code = KEY_CODES.get(key.lower())
+        if code is None:
+            raise ValueError(f"invalid tap key {key!r}")
+        try:
+            count = int(count or "1")
+        except ValueError:
+            count = 0
+        if count <= 0:
+            raise ValueError(f"invalid tap count in {s!r}")
+        return [encode_key_event(code, 1), encode_key_event(code, 0)] * count
+
+    def to_string(self):
+        """
+        Format a rule as a string, the inverse of from_string().
+        """
+        if self.kind == "chord":
+            patterns = "chord:" + "+".join(
+                KEY_NAMES[decode_key_event(key_event)[0]] for key_event in self.patterns
+            )
+        elif self.kind == "tap":
+            code = decode_key_event(self.patterns[0])[0]
+            patterns = f"tap:{KEY_NAMES[code]}*{len(self.patterns) // 2}"
+        else:
+            patterns = format_key_events(map(decode_key_event, self.patterns))
+        s = patterns + "=" + format_key_events(map(decode_key_event, self.actions))
+        if self.consume:
+            s += ";consume"
+        if self.condition is not None:
+            s += f";{self.condition}"
+        if self.within is not None:
+            s += f";within={self.within}"
+        if self.step is not None:
+            s += f";step={self.step}"
+        return s
+
+    @staticmethod
+    def parse_options(options):
+        out = {}
+        for option in options:
+            if option == "consume":
+                out["consume"] = True
+            elif option in RULE_CONDITIONS:
+                if "condition" in out:
+                    raise ValueError(f"conflicting rule option {option!r}")
+                out["condition"] = option
+            elif option.partition("=")[0] in ("within", "step"):
+                name, _, value = option.partition("=")
+                try:
+                    out[name] = int(value)
+                except ValueError:
+                    out[name] = 0
+                if out[name] <= 0:
+                    raise ValueError(f"invalid rule option {option!r}")
+            else:
+                raise ValueError(f"unknown rule option {option!r}")
         return out
 
 
+class RuleAutomaton:
+    """
+    Automaton that matches the patterns of all rules at once.
+
+    The patterns are compiled into a trie with failure links (Aho-Corasick),
+    which is then completed into a transition table, so that matching takes a
+    single lookup per event, regardless of the number of rules.
+
+    Key events used in patterns are numbered as symbols starting at 1, and
+    ``symbols`` maps each encoded key event to its symbol; 0 is used for key
+    events not used in any pattern. The transition table is a flat array with
+    ``width`` (the number of symbols) entries per state, so that the next
+    state is ``transitions[state * width + symbol]``. For each state,
+    ``accepts`` has the indices of the rules (in their original order) whose
+    patterns end in that state, ``consumes`` tells whether any of those
+    consumes the event, and ``checked`` tells whether any of those has a
+    condition or timeout that must be checked when it matches.
+
+    For each state, ``step_timeouts`` has the longest step timeout in
+    nanoseconds of the patterns that can continue from it, and
+    ``default_steps`` tells whether any of those uses the global timeout
+    instead; if the next event comes later, it can only start a new
+    sequence. Rules with timeouts are checked against the timestamps of
+    their events, so ``history`` is the number of timestamps to keep, which
+    is a power of two, or 0 if there are no such rules.
+
+    Chord rules are not part of the automaton, but are indexed separately:
+    ``chords`` maps each key code to the indices of the chord rules using
+    that key, ``chord_masks`` has the bitset of the keys of each chord rule
+    (or 0 for other rules), and ``chord_timeouts`` its timeout in
+    nanoseconds. ``chord_timeout`` is the longest of those, and
+    ``chord_holds`` is the bitset of keys used by chords that consume them.
+
+    Tap rules are indexed as well: ``taps`` maps each key code to a dict
+    from tap counts to the indices of the tap rules for that key and count,
+    and ``tap_timeouts`` has the timeout of each tap rule in nanoseconds.
+    For each key, ``tap_counts`` has the highest count of its tap rules, and
+    ``tap_windows`` their longest timeout.
+    """
+
+    initial_state = 0
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        sequence_rules = [
+            (index, rule)
+            for index, rule in enumerate(self.rules)
+            if rule.kind == "sequence"
+        ]
+
+        self.symbols = array.array("H", [0]) * KEY_EVENT_CNT
+        width = 1
+        for _, rule in sequence_rules:
+            for key_event in rule.patterns:
+                if not self.symbols[key_event]:
+                    self.symbols[key_event] = width
+                    width += 1
+        self.width = width
+
+        # build a trie of all patterns
+        goto = [{}]
+        accepting_rule_indices = [[]]
+        step_timeouts = [0]
+        default_steps = [False]
+        for index, rule in sequence_rules:
+            state = self.initial_state
+            for key_event in rule.patterns:
+                if rule.step is None:
+                    default_steps[state] = True
+                else:
+                    step_timeouts[state] = max(
+                        step_timeouts[state], rule.step * 1_000_000
+                    )
+                symbol = self.symbols[key_event]
+                next_state = goto[state].get(symbol)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][symbol] = next_state
+                    goto.append({})
+                    accepting_rule_indices.append([])
+                    step_timeouts.append(0)
+                    default_steps.append(False)
+                state = next_state
+            accepting_rule_indices[state].append(index)
+
+        # traverse the trie breadth-first, which guarantees that the failure
+        # state (the longest proper suffix that is also in the trie) of each
+        # state is complete before it is needed, and fill in the transitions
+        # and accepting rules inherited from the failure state.
+        n_states = len(goto)
+        typecode = "H" if n_states <= 1 << 16 else "L"
+        transitions = array.array(typecode, [0]) * (n_states * width)
+        for symbol, next_state in goto[self.initial_state].items():
+            transitions[symbol] = next_state
+        failure = [self.initial_state] * n_states
+        queue = collections.deque(goto[self.initial_state].values())
+        while queue:
+            state = queue.popleft()
+            fallback = failure[state]
+            row = state * width
+            fallback_row = fallback * width
+            transitions[row : row + width] = transitions[
+                fallback_row : fallback_row + width
+            ]
+            for symbol, next_state in goto[state].items():
+                transitions[row + symbol] = next_state
+                failure[next_state] = transitions[fallback_row + symbol]
+                queue.append(next_state)
+            accepting_rule_indices[state].extend(accepting_rule_indices[fallback])
+            step_timeouts[state] = max(step_timeouts[state], step_timeouts[fallback])
+            default_steps[state] = default_steps[state] or default_steps[fallback]
+
+        self.transitions = transitions
+        self.accepts = [tuple(sorted(indices)) for indices in accepting_rule_indices]
+        self.consumes = [
+            any(self.rules[index].consume for index in indices)
+            for indices in self.accepts
+        ]
+        self.step_timeouts = array.array("q", step_timeouts)
+        self.default_steps = default_steps
+
+        # when some rules have their own timeouts, a state may allow a longer
+        # step than the rules ending in it, so all matches are checked.
+        timed = any(
+            rule.within is not None or rule.step is not None
+            for _, rule in sequence_rules
+        )
+        self.history = 0
+        if timed:
+            longest = max(len(rule.patterns) for _, rule in sequence_rules)
+            self.history = 1 << (longest - 1).bit_length()
+        self.checked = [
+            bool(indices)
+            and (
+                timed
+                or any(self.rules[index].condition is not None for index in indices)
+            )
+            for indices in self.accepts
+        ]
+
+        chords = collections.defaultdict(list)
+        self.chord_masks = [0] * len(self.rules)
+        self.chord_timeouts = [0] * len(self.rules)
+        self.chord_holds = 0
+        for index, rule in enumerate(self.rules):
+            if rule.kind != "chord":
+                continue
+            for key_event in rule.patterns:
+                code = decode_key_event(key_event)[0]
+                chords[code].append(index)
+                self.chord_masks[index] |= 1 << code
+            within = DEFAULT_CHORD_TIMEOUT if rule.within is None else rule.within
+            self.chord_timeouts[index] = within * 1_000_000
+            if rule.consume:
+                self.chord_holds |= self.chord_masks[index]
+        self.chords = {code: tuple(indices) for code, indices in chords.items()}
+        self.chord_timeout = max(self.chord_timeouts, default=0)
+
+        taps = collections.defaultdict(lambda: collections.defaultdict(list))
+        self.tap_timeouts = [0] * len(self.rules)
+        for index, rule in enumerate(self.rules):
+            if rule.kind != "tap":
+                continue
+            code = decode_key_event(rule.patterns[0])[0]
+            taps[code][len(rule.patterns) // 2].append(index)
+            within = DEFAULT_TAP_TIMEOUT if rule.within is None else rule.within
+            self.tap_timeouts[index] = within * 1_000_000
+        self.taps = {
+            code: {count: tuple(indices) for count, indices in counts.items()}
+            for code, counts in taps.items()
+        }
+        self.tap_counts = {code: max(counts) for code, counts in self.taps.items()}
+        self.tap_windows = {
+            code: max(
+                self.tap_timeouts[index]
+                for indices in counts.values()
+                for index in indices
+            )
+            for code, counts in self.taps.items()
+        }
+
+
+# key names (without the KEY_ prefix) and their codes, from
+# linux/input-event-codes.h; the first name for each code is used for output
+KEY_CODES = {name: int(code) for name, _, code in (item.partition("=") for item in """
+reserved=0 esc=1 1=2 2=3 3=4 4=5 5=6 6=7 7=8 8=9 9=10 0=11 minus=12 equal=13
+backspace=14 tab=15 q=16 w=17 e=18 r=19 t=20 y=21 u=22 i=23 o=24 p=25 leftbrace=26
+rightbrace=27 enter=28 leftctrl=29 a=30 s=31 d=32 f=33 g=34 h=35 j=36 k=37 l=38
+semicolon=39 apostrophe=40 grave=41 leftshift=42 backslash=43 z=44 x=45 c=46 v=47
+b=48 n=49 m=50 comma=51 dot=52 slash=53 rightshift=54 kpasterisk=55 leftalt=56
+space=57 capslock=58 f1=59 f2=60 f3=61 f4=62 f5=63 f6=64 f7=65 f8=66 f9=67 f10=68
+numlock=69 scrolllock=70 kp7=71 kp8=72 kp9=73 kpminus=74 kp4=75 kp5=76 kp6=77
+kpplus=78 kp1=79 kp2=80 kp3=81 kp0=82 kpdot=83 zenkakuhankaku=85 102nd=86 f11=87
+f12=88 ro=89 katakana=90 hiragana=91 henkan=92 katakanahiragana=93 muhenkan=94
+kpjpcomma=95 kpenter=96 rightctrl=97 kpslash=98 sysrq=99 rightalt=100 linefeed=101
+home=102 up=103 pageup=104 left=105 right=106 end=107 down=108 pagedown=109
+insert=110 delete=111 macro=112 mute=113 min_interesting=113 volumedown=114
+volumeup=115 power=116 kpequal=117 kpplusminus=118 pause=119 scale=120 kpcomma=121
+hangeul=122 hanguel=122 hanja=123 yen=124 leftmeta=125 rightmeta=126 compose=127
+stop=128 again=129 props=130 undo=131 front=132 copy=133 open=134 paste=135 find=136
+cut=137 help=138 menu=139 calc=140 setup=141 sleep=142 wakeup=143 file=144
+sendfile=145 deletefile=146 xfer=147 prog1=148 prog2=149 www=150 msdos=151
+coffee=152 screenlock=152 direction=153 rotate_display=153 cyclewindows=154 mail=155
+bookmarks=156 computer=157 back=158 forward=159 closecd=160 ejectcd=161
+ejectclosecd=162 nextsong=163 playpause=164 previoussong=165 stopcd=166 record=167
+rewind=168 phone=169 iso=170 config=171 homepage=172 refresh=173 exit=174 move=175
+edit=176 scrollup=177 scrolldown=178 kpleftparen=179 kprightparen=180 new=181
+redo=182 f13=183 f14=184 f15=185 f16=186 f17=187 f18=188 f19=189 f20=190 f21=191
+f22=192 f23=193 f24=194 playcd=200 pausecd=201 prog3=202 prog4=203
+all_applications=204 dashboard=204 suspend=205 close=206 play=207 fastforward=208
+bassboost=209 print=210 hp=211 camera=212 sound=213 question=214 email=215 chat=216
+search=217 connect=218 finance=219 sport=220 shop=221 alterase=222 cancel=223
+brightnessdown=224 brightnessup=225 media=226 switchvideomode=227 kbdillumtoggle=228
+kbdillumdown=229 kbdillumup=230 send=231 reply=232 forwardmail=233 save=234
+documents=235 battery=236 bluetooth=237 wlan=238 uwb=239 unknown=240 video_next=241
+video_prev=242 brightness_cycle=243 brightness_auto=244 brightness_zero=244
+display_off=245 wimax=246 wwan=246 rfkill=247 micmute=248 ok=352 select=353 goto=354
+clear=355 power2=356 option=357 info=358 time=359 vendor=360 archive=361 program=362
+channel=363 favorites=364 epg=365 pvr=366 mhp=367 language=368 title=369
+subtitle=370 angle=371 full_screen=372 zoom=372 mode=373 keyboard=374
+aspect_ratio=375 screen=375 pc=376 tv=377 tv2=378 vcr=379 vcr2=380 sat=381 sat2=382
+cd=383 tape=384 radio=385 tuner=386 player=387 text=388 dvd=389 aux=390 mp3=391
+audio=392 video=393 directory=394 list=395 memo=396 calendar=397 red=398 green=399
+yellow=400 blue=401 channelup=402 channeldown=403 first=404 last=405 ab=406 next=407
+restart=408 slow=409 shuffle=410 break=411 previous=412 digits=413 teen=414 twen=415
+videophone=416 games=417 zoomin=418 zoomout=419 zoomreset=420 wordprocessor=421
+editor=422 spreadsheet=423 graphicseditor=424 presentation=425 database=426 news=427
+voicemail=428 addressbook=429 messenger=430 brightness_toggle=431 displaytoggle=431
+spellcheck=432 logoff=433 dollar=434 euro=435 frameback=436 frameforward=437
+context_menu=438 media_repeat=439 10channelsup=440 10channelsdown=441 images=442
+notification_center=444 pickup_phone=445 hangup_phone=446 link_phone=447 del_eol=448
+del_eos=449 ins_line=450 del_line=451 fn=464 fn_esc=465 fn_f1=466 fn_f2=467
+fn_f3=468 fn_f4=469 fn_f5=470 fn_f6=471 fn_f7=472 fn_f8=473 fn_f9=474 fn_f10=475
+fn_f11=476 fn_f12=477 fn_1=478 fn_2=479 fn_d=480 fn_e=481 fn_f=482 fn_s=483 fn_b=484
+fn_right_shift=485 brl_dot1=497 brl_dot2=498 brl_dot3=499 brl_dot4=500 brl_dot5=501
+brl_dot6=502 brl_dot7=503 brl_dot8=504 brl_dot9=505 brl_dot10=506 numeric_0=512
+numeric_1=513 numeric_2=514 numeric_3=515 numeric_4=516 numeric_5=517 numeric_6=518
+numeric_7=519 numeric_8=520 numeric_9=521 numeric_star=522 numeric_pound=523
+numeric_a=524 numeric_b=525 numeric_c=526 numeric_d=527 camera_focus=528
+wps_button=529 touchpad_toggle=530 touchpad_on=531 touchpad_off=532
+camera_zoomin=533 camera_zoomout=534 camera_up=535 camera_down=536 camera_left=537
+camera_right=538 attendant_on=539 attendant_off=540 attendant_toggle=541
+lights_toggle=542 als_toggle=560 rotate_lock_toggle=561 refresh_rate_toggle=562
+buttonconfig=576 taskmanager=577 journal=578 controlpanel=579 appselect=580
+screensaver=581 voicecommand=582 assistant=583 kbd_layout_next=584 emoji_picker=585
+dictate=586 brightness_min=592 brightness_max=593 kbdinputassist_prev=608
+kbdinputassist_next=609 kbdinputassist_prevgroup=610 kbdinputassist_nextgroup=611
+kbdinputassist_accept=612 kbdinputassist_cancel=613 right_up=614 right_down=615
+left_up=616 left_down=617 root_menu=618 media_top_menu=619 numeric_11=620
+numeric_12=621 audio_desc=622 3d_mode=623 next_favorite=624 stop_record=625
+pause_record=626 vod=627 unmute=628 fastreverse=629 slowreverse=630 data=631
+onscreen_keyboard=632 privacy_screen_toggle=633 selective_screenshot=634
+next_element=635 previous_element=636 autopilot_engage_toggle=637 mark_waypoint=638
+sos=639 nav_chart=640 fishing_chart=641 single_range_radar=642 dual_range_radar=643
+radar_overlay=644 traditional_sonar=645 clearvu_sonar=646 sidevu_sonar=647
+nav_info=648 brightness_menu=649 macro1=656 macro2=657 macro3=658 macro4=659
+macro5=660 macro6=661 macro7=662 macro8=663 macro9=664 macro10=665 macro11=666
+macro12=667 macro13=668 macro14=669 macro15=670 macro16=671 macro17=672 macro18=673
+macro19=674 macro20=675 macro21=676 macro22=677 macro23=678 macro24=679 macro25=680
+macro26=681 macro27=682 macro28=683 macro29=684 macro30=685 macro_record_start=688
+macro_record_stop=689 macro_preset_cycle=690 macro_preset1=691 macro_preset2=692
+macro_preset3=693 kbd_lcd_menu1=696 kbd_lcd_menu2=697 kbd_lcd_menu3=698
+kbd_lcd_menu4=699 kbd_lcd_menu5=700
+""".split())}
+KEY_NAMES = {}
+for name, code in KEY_CODES.items():
+    KEY_NAMES.setdefault(code, name)
+del name, code
+
+
 if __name__ == "__main__":
     main()
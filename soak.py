@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+"""
+Soak test for hotplug churn in the evcape keyboard monitor.
+
+This drives a KeyboardMonitor with a simulated udev monitor that adds and
+removes keyboards over and over, while typing on the simulated keyboards,
+and periodically reports the number of open file descriptors, the resident
+memory size, and the latencies of events and hotplug handling::
+
+  ./soak.py
+  ./soak.py --cycles 100000 --devices 8 --report-every 5000
+
+No hardware is needed: keyboards are pseudo terminals carrying raw input
+events, which, like real device nodes, each have their own device number.
+
+This exits with an error if the number of open file descriptors or the
+resident memory size grew between the first and the last report.
+"""
+
+import argparse
+import collections
+import logging
+import os
+import random
+import time
+import tty
+
+import evcape
+
+# letters, digits and the like; typing uses these keys
+KEYS = list(range(2, 54))
+STALL_TIMEOUT = 5_000_000_000  # 5s in nanoseconds
+
+FakeUdevDevice = collections.namedtuple("FakeUdevDevice", ["action", "properties"])
+FakeInputEvent = collections.namedtuple(
+    "FakeInputEvent", ["sec", "usec", "type", "code", "value"]
+)
+
+
+class FakeUdevMonitor:
+    """
+    Stand-in for pyudev.Monitor, with hotplug events added by emit().
+    """
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        self.devices = collections.deque()
+
+    def emit(self, action, path):
+        properties = {"ID_INPUT_KEYBOARD": "1", "DEVNAME": path}
+        self.devices.append(FakeUdevDevice(action, properties))
+        os.write(self.write_fd, b"\0")
+
+    def poll(self, timeout=None):
+        if not self.devices:
+            return None
+        os.read(self.read_fd, 1)
+        return self.devices.popleft()
+
+    def fileno(self):
+        return self.read_fd
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
+class FakeInputDevice:
+    """
+    Stand-in for evdev.InputDevice, backed by a pseudo terminal.
+
+    Raw input events written to ``write_fd`` can be read from ``fd``.
+    """
+
+    name = "soak keyboard"
+
+    def __init__(self, path):
+        self.path = path
+        self.write_fd, self.fd = os.openpty()
+        tty.setraw(self.fd)
+        os.set_blocking(self.fd, False)
+
+    def capabilities(self, absinfo=True):
+        return {evcape.EV_KEY: KEYS}
+
+    def grab(self):
+        pass
+
+    def read(self):
+        data = os.read(self.fd, evcape.RAW_READ_SIZE)
+        return [
+            FakeInputEvent(*event) for event in evcape.INPUT_EVENT.iter_unpack(data)
+        ]
+
+    def write(self, code, value):
+        timestamp = time.monotonic_ns()
+        event = evcape.INPUT_EVENT.pack(
+            timestamp // 1_000_000_000,
+            timestamp % 1_000_000_000 // 1000,
+            evcape.EV_KEY,
+            code,
+            value,
+        )
+        os.write(self.write_fd, event)
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            os.close(self.write_fd)
+            self.fd = self.write_fd = -1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cycles", type=int, default=20_000)
+    parser.add_argument(
+        "--devices", type=int, default=4, help="number of simultaneous keyboards"
+    )
+    parser.add_argument(
+        "--events", type=int, default=20, help="key events per hotplug cycle"
+    )
+    parser.add_argument("--report-every", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--raw",
+        action="store_true",
+        help="decode input events directly, like evcape --raw",
+    )
+    parser.add_argument(
+        "--max-rss-growth",
+        type=float,
+        default=4.0,
+        help="allowed growth of the resident memory size in MiB",
+    )
+    args = parser.parse_args()
+
+    # the simulated keyboards do not support the ioctls for real ones
+    logging.basicConfig(level=logging.ERROR)
+
+    reports = soak(args)
+    first, last = reports[0], reports[-1]
+    errors = []
+    if last["fds"] > first["fds"]:
+        errors.append(f"open fds grew from {first['fds']} to {last['fds']}")
+    if last["rss"] - first["rss"] > args.max_rss_growth:
+        errors.append(f"rss grew from {first['rss']:.1f}MiB to {last['rss']:.1f}MiB")
+    if errors:
+        raise SystemExit("\n".join(errors))
+
+
+def soak(args):
+    rng = random.Random(args.seed)
+    automaton = evcape.RuleAutomaton(
+        [evcape.Rule.from_string(s) for s in evcape.DEFAULT_RULES]
+    )
+    matcher = evcape.Matcher(automaton, timeout=evcape.DEFAULT_TIMEOUT * 1_000_000)
+    udev_monitor = FakeUdevMonitor()
+    devices = {}
+    keyboard_monitor = evcape.KeyboardMonitor(
+        ignored_devices=[],
+        raw=args.raw,
+        new_device_state=matcher.new_state,
+        drop_device_state=matcher.drop_state,
+        udev_monitor=udev_monitor,
+        open_input_device=devices.__getitem__,
+    )
+    matcher.call_at = keyboard_monitor.call_at
+    null_fd = os.open(os.devnull, os.O_WRONLY)
+    matcher.writer = evcape.FrameWriter(null_fd)
+
+    # time the handling of hotplug events
+    hotplug_latency = evcape.LatencyHistogram()
+    for name in ["add_keyboard", "remove_keyboard"]:
+        function = getattr(keyboard_monitor, name)
+        setattr(
+            keyboard_monitor,
+            name,
+            timed(function, lambda latency: hotplug_latency.add(latency)),
+        )
+
+    def stall():
+        raise RuntimeError("no events received; is the monitor stuck?")
+
+    print(
+        f"{'cycles':>8} {'time':>7} {'fds':>5} {'rss':>9} {'devices':>7} "
+        f"{'event p50':>9} {'p99':>7} {'max':>7} "
+        f"{'hotplug p50':>11} {'p99':>7} {'max':>7}"
+    )
+    reports = []
+    event_latency = evcape.LatencyHistogram()
+    start = time.monotonic()
+    with keyboard_monitor:
+        events = iter(keyboard_monitor)
+        for cycle in range(1, args.cycles + 1):
+            # replace a keyboard, like a kvm switch or docking station would
+            path = f"/dev/input/event{100 + cycle % args.devices}"
+            if path in devices:
+                udev_monitor.emit("remove", path)
+                del devices[path]
+            devices[path] = FakeInputDevice(path)
+            udev_monitor.emit("add", path)
+
+            # type on the keyboards, and wait for all events to arrive
+            paths = list(devices)
+            for _ in range(args.events // 2):
+                device = devices[rng.choice(paths)]
+                code = rng.choice(KEYS)
+                device.write(code, 1)
+                device.write(code, 0)
+            timer = keyboard_monitor.call_at(time.monotonic_ns() + STALL_TIMEOUT, stall)
+            for _ in range(args.events // 2 * 2):
+                device_state, timestamp, code, value = next(events)
+                event_latency.add(time.monotonic_ns() - timestamp)
+                matcher.feed(device_state, timestamp, code, value)
+            matcher.writer.flush()
+            timer.cancel()
+
+            if cycle % args.report_every == 0 or cycle == args.cycles:
+                report = {
+                    "fds": len(os.listdir("/proc/self/fd")),
+                    "rss": rss(),
+                }
+                reports.append(report)
+                print(
+                    f"{cycle:>8} {time.monotonic() - start:>6.1f}s "
+                    f"{report['fds']:>5} {report['rss']:>6.1f}MiB "
+                    f"{len(keyboard_monitor.keyboards):>7} "
+                    f"{event_latency.percentile(50):>7}µs "
+                    f"{event_latency.percentile(99):>5}µs "
+                    f"{event_latency.max:>5}µs "
+                    f"{hotplug_latency.percentile(50):>9}µs "
+                    f"{hotplug_latency.percentile(99):>5}µs "
+                    f"{hotplug_latency.max:>5}µs"
+                )
+                event_latency = evcape.LatencyHistogram()
+                hotplug_latency = evcape.LatencyHistogram()
+    for device in devices.values():
+        device.close()
+    udev_monitor.close()
+    os.close(null_fd)
+    return reports
+
+
+def timed(function, add_latency):
+    def wrapper(*args):
+        start = time.monotonic_ns()
+        try:
+            return function(*args)
+        finally:
+            add_latency(time.monotonic_ns() - start)
+
+    return wrapper
+
+
+def rss():
+    """
+    Return the resident memory size in MiB.
+    """
+    with open("/proc/self/statm") as fp:
+        pages = int(fp.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+if __name__ == "__main__":
+    main()